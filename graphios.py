@@ -36,16 +36,40 @@
 
 from ConfigParser import SafeConfigParser
 from optparse import OptionParser
+import array
+import collections
 import copy
+import cPickle as pickle
+import ctypes
+import ctypes.util
+import errno
 import graphios_backends as backends
+import hashlib
+import json
 import logging
 import logging.handlers
+import multiprocessing
 import os
 import os.path
 import re
+import select
+import signal
+import socket
+import stat
+import string
+import struct
 import sys
+import threading
 import time
 
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
 
 # ##########################################################
 # ###  Do not edit this file, edit the graphios.cfg    #####
@@ -70,6 +94,34 @@ cfg = {}
 # backend global
 be = ""
 
+# spool worker pool, only used when spool_workers > 1
+pool = None
+
+# graphios' own stats for the current pass, a SelfStats
+stats = None
+
+# spool files the last pass left for the next one (spool_max_files/size)
+deferred_files = 0
+
+# pre-aggregates metrics before they're sent, an Aggregator when aggregate
+# is on
+aggregator = None
+
+# which backends took which points, a Deduplicator when dedup is on
+dedup = None
+
+# per second rates of the counters, a RateDeriver when rates is on
+rates = None
+
+# the last thresholds sent, a ChangeFilter when thresholds is on
+threshold_changes = None
+
+# the last values sent, a ChangeFilter when changes_only is on
+changes = None
+
+# what a spool worker logged, a WorkerLogHandler in the workers
+worker_log = None
+
 # available loglevels for graphios.cfg
 loglevels = {
     'logging.DEBUG':    logging.DEBUG,
@@ -118,6 +170,15 @@ parser.add_option("--reverse_hostname", action="store_true",
 
 log = logging.getLogger('log')
 
+# str.translate() deletion tables used by the stream parser. Deleting these
+# is equivalent to re.sub("[a-zA-Z%]", "", v) and re.sub("[^a-zA-Z]+", "", v)
+value_strip_chars = string.ascii_letters + '%'
+uom_strip_chars = ''.join([chr(c) for c in range(256)
+                           if chr(c) not in string.ascii_letters])
+
+# the thresholds after a perfdata value, in order
+threshold_kinds = ("warn", "crit", "min", "max")
+
 
 class GraphiosMetric(object):
     def __init__(self):
@@ -181,6 +242,60 @@ class GraphiosMetric(object):
                                                   cfg["replacement_character"])
 
 
+class PerfMetric(object):
+    """
+    A single perfdata label of a check result. Only LABEL, VALUE and UOM are
+    stored per metric, every other attribute (HOSTNAME, TIMET, PERFDATA etc.)
+    is read from the GraphiosMetric of the check result it came from, which
+    is shared by all the labels of that check result.
+    """
+    __slots__ = ('context', 'LABEL', 'VALUE', 'UOM')
+
+    def __init__(self, context, label, value, uom):
+        self.context = context          # GraphiosMetric of the check result
+        self.LABEL = label
+        self.VALUE = value
+        self.UOM = uom
+
+    def __getattr__(self, name):
+        # only called for attributes that aren't slots
+        if name == 'context':
+            raise AttributeError(name)
+        return getattr(self.context, name)
+
+    def __getstate__(self):
+        return (self.context, self.LABEL, self.VALUE, self.UOM)
+
+    def __setstate__(self, state):
+        (self.context, self.LABEL, self.VALUE, self.UOM) = state
+
+
+class ThresholdMetric(PerfMetric):
+    """
+    A warn, crit, min or max threshold of a perfdata label, see
+    threshold_metrics.
+    """
+    __slots__ = ()
+
+
+def metric_context(m):
+    """
+    returns the check result a metric came from, the legacy parser's
+    GraphiosMetrics are their own. Reading its fields directly skips
+    PerfMetric.__getattr__.
+    """
+    return getattr(m, "context", m)
+
+
+def metric_key(m):
+    """
+    returns the fields that tell one metric apart from any other
+    """
+    c = metric_context(m)
+    return (c.METRICBASEPATH, c.GRAPHITEPREFIX, c.HOSTNAME, c.SERVICEDESC,
+            c.GRAPHITEPOSTFIX, m.LABEL)
+
+
 def chk_bool(value):
     """
     checks if value is a stringified boolean
@@ -328,6 +443,19 @@ def configure():
         print "log_max_size needs to be a integer"
         sys.exit(1)
 
+    try:
+        cfg["spool_workers"] = int(cfg.get("spool_workers", 0))
+    except ValueError:
+        print "spool_workers needs to be a integer"
+        sys.exit(1)
+
+    try:
+        cfg["spool_max_files"] = int(cfg.get("spool_max_files", 0))
+        cfg["spool_max_size"] = int(cfg.get("spool_max_size", 0))
+    except ValueError:
+        print "spool_max_files and spool_max_size need to be integers"
+        sys.exit(1)
+
     # Convert cfg["log_max_size"] to bytes. Assume its already in bytes
     # if its > 1000000
     if cfg["log_max_size"] < 1000000:
@@ -356,7 +484,129 @@ def configure():
 
 
 def process_log(file_name):
-    """ process log lines into GraphiosMetric Objects.
+    """
+    process a spool file into GraphiosMetric objects with the configured
+    parser_engine ('stream' by default, 'legacy' for the original parser).
+    """
+    if cfg.get("parser_engine", "stream") == "legacy":
+        return legacy_process_log(file_name)
+    return stream_process_log(file_name)
+
+
+def stream_process_log(file_name):
+    """ process log lines into PerfMetric Objects.
+    Reads the spool file one line at a time and splits every field exactly
+    once with plain string operations. The metrics produced are identical
+    to legacy_process_log, but every label shares the GraphiosMetric of its
+    check result instead of getting a copy of it.
+    """
+    processed_objects = []  # the final list of metric objects we'll return
+    parse_thresholds = cfg.get("thresholds") is True
+    try:
+        host_data_file = open(file_name, "r")
+    except (IOError, OSError) as ex:
+        log.critical("Can't open file:%s error: %s" % (file_name, ex))
+        sys.exit(2)
+    try:
+        for line in host_data_file:
+            if not line.startswith("DATATYPE::"):
+                continue
+            mobj = parse_line(line)
+            if not mobj:
+                continue
+            for metric in mobj.PERFDATA.split():
+                fields = metric.split('=')
+                if len(fields) != 2:
+                    log.critical("failed to parse label: '%s' part of perf"
+                                 "string '%s'" % (metric, mobj.PERFDATA))
+                    continue
+                (v, sep, limits) = fields[1].partition(';')
+                processed_objects.append(
+                    PerfMetric(mobj, fields[0],
+                               v.translate(None, value_strip_chars),
+                               v.translate(None, uom_strip_chars)))
+                if limits and parse_thresholds:
+                    processed_objects.extend(
+                        threshold_metrics(mobj, fields[0], limits))
+    except (IOError, OSError) as ex:
+        log.critical("Can't read file:%s error: %s" % (file_name, ex))
+        sys.exit(2)
+    finally:
+        host_data_file.close()
+    return processed_objects
+
+
+def threshold_metrics(mobj, label, limits):
+    """
+    returns ThresholdMetrics for the warn;crit;min;max after a perfdata
+    value, labelled <label>.warn etc. Empty ones and ranges are skipped.
+    """
+    metrics = []
+    for (kind, limit) in zip(threshold_kinds, limits.split(';')):
+        if limit == "":
+            continue
+        try:
+            float(limit)
+        except ValueError:
+            continue
+        metrics.append(ThresholdMetric(mobj, "%s.%s" % (label, kind), limit,
+                                       ""))
+    return metrics
+
+
+def init_thresholds():
+    """
+    sets up the ChangeFilter of the thresholds, sending unchanged ones every
+    thresholds_heartbeat seconds
+    """
+    global threshold_changes
+    try:
+        heartbeat = int(cfg.get("thresholds_heartbeat", 600))
+    except ValueError:
+        log.critical("thresholds_heartbeat needs to be a integer")
+        sys.exit(1)
+    threshold_changes = ChangeFilter(heartbeat)
+
+
+def suppress_thresholds(metrics):
+    """
+    drops the ThresholdMetrics that didn't change since they were last sent,
+    unless that was thresholds_heartbeat seconds ago
+    """
+    kept = [m for m in metrics
+            if type(m) is not ThresholdMetric or threshold_changes.keep(m)]
+    stats.add("thresholds.suppressed", len(metrics) - len(kept))
+    return kept
+
+
+def parse_line(line):
+    """
+        takes a raw spool line and returns a mobj if it's valid, otherwise
+        returns False. Same rules as get_mobj, without the regexes.
+    """
+    mobj = GraphiosMetric()
+    replacement_character = cfg["replacement_character"]
+    for var in line.split('\t'):
+        (var_name, sep, value) = var.partition('::')
+        # drop the metric if we can't split it for any reason
+        if not sep:
+            log.warn("could not split value %s, dropping metric" % var)
+            return False
+        value = value.replace("/", replacement_character)
+        if "PERFDATA" in var_name:
+            mobj.PERFDATA = value
+        elif value.startswith("$_"):
+            continue
+        else:
+            setattr(mobj, var_name, "".join(value.split()))
+    mobj.validate()
+    if mobj.VALID is True:
+        return mobj
+    return False
+
+
+def legacy_process_log(file_name):
+    """ process log lines into GraphiosMetric Objects (the original parser).
     input is a tab delimited series of key/values each of which are delimited
     by '::' it looks like:
     DATATYPE::HOSTPERFDATA  TIMET::1399738074 etc..
@@ -442,33 +692,53 @@ def handle_file(file_name, graphite_lines):
 
 def process_spool_dir(directory):
     """
-    processes the files in the spool directory
+    processes the files in the spool directory, then the retry queues.
+    returns how many files were kept because a backend didn't take all of
+    their metrics (and they couldn't be queued)
     """
     global be
+    global stats
+    global deferred_files
     log.debug("Processing spool directory %s", directory)
+    stats = SelfStats()
     num_files = 0
+    num_kept = 0
+    num_metrics = 0
     mobjs_len = 0
+    start = time.time()
     try:
-        perfdata_files = os.listdir(directory)
+        spool_files = list_spool_dir(directory)
     except (IOError, OSError) as e:
         print "Exception '%s' reading spool directory: %s" % (e, directory)
         print "Check if dir exists, or file permissions."
         print "Exiting."
         sys.exit(1)
-    for perfdata_file in perfdata_files:
-        mobjs = []
-        processed_dict = {}
+    stats.add_backlog([spool_file[2] for spool_file in spool_files])
+    (file_dirs, deferred_files) = pick_spool_files(spool_files)
+    if deferred_files > 0:
+        log.info("leaving %s spool files for the next pass" %
+                 deferred_files)
+    stats.add("spool.listdir_time", time.time() - start)
+    for (file_dir, mobjs) in parse_files(file_dirs):
         all_done = True
-        file_dir = os.path.join(directory, perfdata_file)
-        if check_skip_file(perfdata_file, file_dir):
-            continue
         num_files += 1
-        mobjs = process_log(file_dir)
+        num_metrics += len(mobjs)
+        if threshold_changes is not None:
+            mobjs = suppress_thresholds(mobjs)
+        if rates is not None:
+            mobjs = rates.derive(mobjs)
+        if aggregator is not None:
+            mobjs = aggregator.absorb(mobjs)
+        if changes is not None:
+            mobjs = changes.filter(mobjs)
         mobjs_len = len(mobjs)
         processed_dict = send_backends(mobjs)
         # process the output from the backends and decide the fate of the file
         for backend in be["essential_backends"]:
             if processed_dict[backend] < mobjs_len:
+                if queue_metrics(backend, unsent_metrics(
+                        backend, mobjs, processed_dict[backend])):
+                    continue
                 log.critical("keeping %s, insufficent metrics sent from %s. \
                              Should be %s, got %s" % (file_dir, backend,
                                                       mobjs_len,
@@ -476,13 +746,1007 @@ def process_spool_dir(directory):
                 all_done = False
         if all_done is True:
             handle_file(file_dir, len(mobjs))
+        else:
+            num_kept += 1
     log.info("Processed %s files (%s metrics) in %s" % (num_files,
-             mobjs_len, directory))
+             num_metrics, directory))
+    send_aggregated()
+    for change_filter in (changes, threshold_changes):
+        if change_filter is not None:
+            change_filter.prune(time.time())
+    save_aggregates()
+    save_rates()
+    process_retry_queues()
+    stats.add("spool.files", num_files)
+    stats.add("spool.metrics", num_metrics)
+    stats.add("spool.kept", num_kept)
+    for backend in be["retry_queues"]:
+        stats.add("%s.retry_queue_bytes" % backend,
+                  be["retry_queues"][backend].size())
+    for backend in be["enabled_backends"]:
+        path_cache = getattr(be["enabled_backends"][backend], "path_cache",
+                             None)
+        if path_cache is not None:
+            stats.add("%s.path_cache_hits" % backend, path_cache.hits)
+            stats.add("%s.path_cache_misses" % backend, path_cache.misses)
+            stats.add("%s.path_cache_size" % backend, len(path_cache))
+        dropped = getattr(be["enabled_backends"][backend], "dropped", None)
+        if dropped is not None:
+            stats.add("%s.dropped" % backend, dropped)
+    stats.add("pass_time", time.time() - start)
+    send_self_metrics()
+    return num_kept
+
+
+class SelfStats(object):
+    """
+    What graphios did during one pass over the spool directory: timings,
+    counts and the spool backlog, by metric label.
+    """
+    def __init__(self):
+        self.values = {}
+        self.timet = int(time.time())
+
+    def add(self, name, value):
+        self.values[name] = self.values.get(name, 0) + value
+
+    def add_backlog(self, file_dirs):
+        """
+        how many files are waiting, and the age of the oldest one going by
+        the $TIMET$ the nagios commands add to the file name
+        """
+        self.add("spool.backlog", len(file_dirs))
+        oldest = None
+        for file_dir in file_dirs:
+            timet = file_dir.rsplit(".", 1)[-1]
+            if timet.isdigit() and (oldest is None or int(timet) < oldest):
+                oldest = int(timet)
+        if oldest is not None:
+            self.add("spool.oldest_age", max(self.timet - oldest, 0))
+        else:
+            self.add("spool.oldest_age", 0)
+
+    def metrics(self):
+        """
+        returns the stats as metrics, as if they were the perfdata of a
+        graphios service on this host
+        """
+        mobj = GraphiosMetric()
+        mobj.DATATYPE = "SERVICEPERFDATA"
+        mobj.TIMET = str(self.timet)
+        mobj.HOSTNAME = socket.gethostname()
+        mobj.SERVICEDESC = "graphios"
+        mobj.GRAPHITEPREFIX = cfg.get("self_metrics_prefix", "graphios")
+        mobj.check_adjust_hostname()
+        mobj.VALID = True
+        mobj.PERFDATA = " ".join(["%s=%s" % (name, self.values[name])
+                                  for name in sorted(self.values)])
+        metrics = []
+        for name in sorted(self.values):
+            value = self.values[name]
+            if isinstance(value, float):
+                value = "%.6f" % value
+            metrics.append(PerfMetric(mobj, name, str(value), ""))
+        return metrics
+
+
+def send_self_metrics():
+    """
+    sends graphios' own stats to the backends when self_metrics is on
+    """
+    if cfg.get("self_metrics") is not True:
+        return
+    metrics = stats.metrics()
+    log.debug("sending %s self metrics" % len(metrics))
+    send_backends(metrics)
+
+
+def unsent_metrics(backend, metrics, processed):
+    """
+    returns the metrics a backend didn't take. A backend that knows which
+    ones those were says so in its unsent attribute, otherwise it's all of
+    them.
+    """
+    unsent = getattr(be["enabled_backends"][backend], "unsent", None)
+    if (unsent is not None and processed > 0 and
+            len(unsent) == len(metrics) - processed):
+        return unsent
+    return metrics
+
+
+def queue_metrics(backend, metrics):
+    """
+    puts the metrics a backend didn't take in its retry queue, returns False
+    if there's no retry queue for it or the metrics couldn't be queued
+    """
+    if backend not in be["retry_queues"]:
+        return False
+    try:
+        be["retry_queues"][backend].put(metrics)
+    except (IOError, OSError, pickle.PicklingError) as ex:
+        log.critical("couldn't queue metrics for %s: %s" % (backend, ex))
+        return False
+    log.warning("queued %s metrics for %s to retry" % (len(metrics),
+                                                       backend))
+    return True
+
+
+def process_retry_queues():
+    """
+    resends the queued metrics of each backend, oldest first, until its
+    queue is empty or it fails again. A backend that failed is retried
+    after sleep_time seconds, doubling after each failure up to sleep_max,
+    so only its queue waits and the spool files keep going to the others.
+    """
+    for backend in be["retry_queues"]:
+        queue = be["retry_queues"][backend]
+        if time.time() < queue.next_attempt:
+            continue
+        while True:
+            segment = queue.oldest()
+            if segment is None:
+                break
+            metrics = queue.read(segment)
+            processed = send_backends(metrics, [backend])[backend]
+            if processed < len(metrics):
+                queue.backoff = min(max(queue.backoff * 2,
+                                        float(cfg["sleep_time"])),
+                                    float(cfg["sleep_max"]))
+                queue.next_attempt = time.time() + queue.backoff
+                log.warning("%s still failing, %s bytes of metrics queued, "
+                            "retrying in %ss" % (backend, queue.size(),
+                                                 queue.backoff))
+                break
+            log.info("resent %s queued metrics to %s" % (len(metrics),
+                                                         backend))
+            queue.remove(segment)
+            queue.backoff = 0
+
+
+class RetryQueue(object):
+    """
+    An on disk queue of the metrics one backend failed to take. Metrics are
+    appended as length prefixed pickles to segment files of about
+    segment_size bytes, which are resent and removed oldest first. When the
+    queue grows past max_size the oldest segments are dropped.
+    """
+    segment_size = 1048576
+    header = struct.Struct("!L")
+
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+        self.segments = []  # segment file names, oldest first
+        self.sizes = {}     # segment file name: bytes
+        self.backoff = 0  # seconds to wait after the last failed resend
+        self.next_attempt = 0
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        for name in sorted(os.listdir(directory)):
+            if name.endswith(".seg"):
+                self.segments.append(name)
+                self.sizes[name] = os.path.getsize(
+                    os.path.join(directory, name))
+        if self.segments:
+            self.next_id = int(self.segments[-1].split(".")[0]) + 1
+        else:
+            self.next_id = 0
+
+    def size(self):
+        return sum(self.sizes.values())
+
+    def put(self, metrics):
+        """
+        appends the metrics to the newest segment, and makes sure they're on
+        disk before returning
+        """
+        payload = pickle.dumps(metrics, pickle.HIGHEST_PROTOCOL)
+        if (
+            not self.segments or
+            self.sizes[self.segments[-1]] >= self.segment_size
+        ):
+            self.segments.append("%016d.seg" % self.next_id)
+            self.sizes[self.segments[-1]] = 0
+            self.next_id += 1
+        name = self.segments[-1]
+        segment = open(os.path.join(self.directory, name), "ab")
+        try:
+            segment.write(self.header.pack(len(payload)) + payload)
+            segment.flush()
+            os.fsync(segment.fileno())
+        finally:
+            segment.close()
+        self.sizes[name] += self.header.size + len(payload)
+        self.evict()
+
+    def evict(self):
+        while len(self.segments) > 1 and self.size() > self.max_size:
+            name = self.segments[0]
+            log.critical("retry queue %s is over %s bytes, dropping %s" % (
+                         self.directory, self.max_size, name))
+            self.remove(name)
+
+    def oldest(self):
+        if self.segments:
+            return self.segments[0]
+        return None
+
+    def read(self, name):
+        """
+        returns all the metrics in a segment, skipping the records that
+        can't be unpickled
+        """
+        metrics = []
+        bad = 0
+        segment = open(os.path.join(self.directory, name), "rb")
+        try:
+            data = segment.read()
+        finally:
+            segment.close()
+        offset = 0
+        while offset + self.header.size <= len(data):
+            length = self.header.unpack_from(data, offset)[0]
+            offset += self.header.size
+            if offset + length > len(data):
+                break
+            try:
+                record = pickle.loads(data[offset:offset + length])
+                if not isinstance(record, list):
+                    raise TypeError("%s instead of a list" %
+                                    type(record).__name__)
+                metrics.extend(record)
+            except Exception as ex:
+                log.critical("skipping a corrupt record at byte %s of %s "
+                             "error:%s" % (offset, name, ex))
+                bad += 1
+            offset += length
+        if offset != len(data):
+            log.warning("ignoring a truncated record at the end of %s" %
+                        name)
+        if bad:
+            log.critical("dropped %s corrupt records of %s" % (bad, name))
+        return metrics
+
+    def remove(self, name):
+        try:
+            os.remove(os.path.join(self.directory, name))
+        except (IOError, OSError) as ex:
+            log.critical("couldn't remove %s error:%s" % (name, ex))
+        self.segments.remove(name)
+        del self.sizes[name]
+
+
+class Aggregator(object):
+    """
+    Pre-aggregates the metrics that match the aggregate_rules into one point
+    per window for each of the rule's functions, timestamped with the start
+    of the window. A window is done when a point of a later window comes in
+    for the same metric, or aggregate_delay seconds after it ended. Points
+    for a window that is done already are dropped as late. A point that
+    isn't newer than the last one taken into its window is ignored as
+    repeated, its spool file was kept and is being processed again.
+
+    The running values of every metric are kept in arrays indexed by the
+    metric's slot, next to the last PerfMetric seen for it (to send the
+    aggregates with its context). The windows in progress are saved to a
+    state file now and then and when graphios stops, as their spool files
+    are gone by then.
+    """
+    functions = ("avg", "min", "max", "last", "sum", "count")
+
+    def __init__(self, rules, delay, save_interval=60):
+        self.rules = rules  # [(compiled pattern, window, functions)]
+        self.delay = delay
+        self.save_interval = save_interval
+        self.rule_cache = backends.PathCache(100000)  # key: rule, -1 for none
+        self.slots = {}  # metric key: slot
+        self.keys = []  # slot: metric key, None when free
+        self.free = []
+        self.metrics = []  # slot: last PerfMetric
+        self.rule = array.array("i")
+        self.start = array.array("l")  # window start, -1 before the first
+        self.count = array.array("l")  # 0 once the window is sent
+        self.total = array.array("d")
+        self.low = array.array("d")
+        self.high = array.array("d")
+        self.last = array.array("d")
+        self.latest = array.array("l")  # TIMET of the window's last point
+        self.out = []  # aggregates of the windows that are done
+        self.points_in = 0
+        self.late = 0
+        self.repeated = 0
+        self.saved = time.time()
+
+    def match(self, m):
+        """
+        returns the index of the first rule matching the metric's
+        hostname.servicedesc.label, -1 if there isn't one
+        """
+        name = "%s.%s.%s" % (m.HOSTNAME, m.SERVICEDESC, m.LABEL)
+        for i in xrange(len(self.rules)):
+            if self.rules[i][0].search(name) is not None:
+                return i
+        return -1
+
+    def new_slot(self, key, rule, m):
+        if self.free:
+            slot = self.free.pop()
+            self.keys[slot] = key
+            self.metrics[slot] = m
+            self.rule[slot] = rule
+            self.start[slot] = -1
+            self.count[slot] = 0
+        else:
+            slot = len(self.keys)
+            self.keys.append(key)
+            self.metrics.append(m)
+            self.rule.append(rule)
+            self.start.append(-1)
+            self.count.append(0)
+            self.latest.append(-1)
+            for values in (self.total, self.low, self.high, self.last):
+                values.append(0.0)
+        self.slots[key] = slot
+        return slot
+
+    def add(self, m):
+        """
+        takes the metric into its window, returns False if it isn't one to
+        aggregate
+        """
+        key = metric_key(m)
+        slot = self.slots.get(key)
+        if slot is None:
+            rule = self.rule_cache.get(key)
+            if rule is None:
+                rule = self.match(m)
+                self.rule_cache.put(key, rule)
+            if rule < 0:
+                return False
+        try:
+            value = float(m.VALUE)
+            timet = int(m.TIMET)
+        except ValueError:
+            return False
+        if slot is None:
+            slot = self.new_slot(key, rule, m)
+        self.points_in += 1
+        window = self.rules[self.rule[slot]][1]
+        start = timet - timet % window
+        if start < self.start[slot] or (
+                start == self.start[slot] and self.count[slot] == 0):
+            self.late += 1
+            return True
+        if start == self.start[slot] and timet <= self.latest[slot]:
+            self.repeated += 1
+            return True
+        if start > self.start[slot]:
+            if self.count[slot] > 0:
+                self.emit(slot)
+            self.start[slot] = start
+            self.count[slot] = 1
+            self.total[slot] = value
+            self.low[slot] = value
+            self.high[slot] = value
+        else:
+            self.count[slot] += 1
+            self.total[slot] += value
+            self.low[slot] = min(self.low[slot], value)
+            self.high[slot] = max(self.high[slot], value)
+        self.last[slot] = value
+        self.latest[slot] = timet
+        self.metrics[slot] = m
+        return True
+
+    def absorb(self, metrics):
+        """
+        returns the metrics that aren't aggregated, taking in the others
+        """
+        return [m for m in metrics if not self.add(m)]
+
+    def emit(self, slot):
+        """
+        adds the aggregates of the slot's window to out, and marks it sent
+        """
+        m = self.metrics[slot]
+        context = copy.copy(metric_context(m))
+        context.TIMET = str(self.start[slot])
+        count = self.count[slot]
+        functions = self.rules[self.rule[slot]][2]
+        for function in functions:
+            uom = m.UOM
+            if function == "avg":
+                value = repr(self.total[slot] / count)
+            elif function == "min":
+                value = repr(self.low[slot])
+            elif function == "max":
+                value = repr(self.high[slot])
+            elif function == "last":
+                value = repr(self.last[slot])
+            elif function == "sum":
+                value = repr(self.total[slot])
+            else:
+                value = str(count)
+                uom = ""
+            if len(functions) == 1:
+                label = m.LABEL
+            else:
+                label = "%s_%s" % (m.LABEL, function)
+            self.out.append(PerfMetric(context, label, value, uom))
+        self.count[slot] = 0
+
+    def flush(self, now):
+        """
+        returns the aggregates of the windows that are done, freeing the
+        slots of metrics that stopped coming
+        """
+        for slot in xrange(len(self.keys)):
+            if self.keys[slot] is None:
+                continue
+            window = self.rules[self.rule[slot]][1]
+            end = self.start[slot] + window
+            if self.count[slot] > 0:
+                if end + self.delay <= now:
+                    self.emit(slot)
+            elif end + self.delay + window <= now:
+                del self.slots[self.keys[slot]]
+                self.keys[slot] = None
+                self.metrics[slot] = None
+                self.free.append(slot)
+        out = self.out
+        self.out = []
+        return out
+
+    def load(self, state_file):
+        """
+        reads the windows in progress back from state_file, if there is one.
+        Windows of metrics no rule matches anymore are dropped.
+        """
+        try:
+            state = open(state_file, "rb")
+        except IOError as ex:
+            if ex.errno != errno.ENOENT:
+                raise
+            return
+        try:
+            (self.out, windows) = pickle.load(state)
+        finally:
+            state.close()
+        for (m, start, count, total, low, high, last, latest) in windows:
+            rule = self.match(m)
+            if rule < 0:
+                continue
+            slot = self.new_slot(metric_key(m), rule, m)
+            self.start[slot] = start
+            self.count[slot] = count
+            self.total[slot] = total
+            self.low[slot] = low
+            self.high[slot] = high
+            self.last[slot] = last
+            self.latest[slot] = latest
+
+    def save(self, state_file):
+        """
+        writes the windows in progress, and the aggregates not flushed yet,
+        to state_file
+        """
+        windows = [(self.metrics[slot], self.start[slot], self.count[slot],
+                    self.total[slot], self.low[slot], self.high[slot],
+                    self.last[slot], self.latest[slot])
+                   for slot in xrange(len(self.keys))
+                   if self.keys[slot] is not None and self.count[slot] > 0]
+        tmp_file = "%s.tmp" % state_file
+        state = open(tmp_file, "wb")
+        try:
+            pickle.dump((self.out, windows), state, pickle.HIGHEST_PROTOCOL)
+            state.flush()
+            os.fsync(state.fileno())
+        finally:
+            state.close()
+        os.rename(tmp_file, state_file)
+        self.saved = time.time()
+
+
+def init_aggregator():
+    """
+    sets up the Aggregator from aggregate_rules, a json list of
+    {"pattern": regex, "window": seconds, "functions": [...]}
+    """
+    global aggregator
+    rules = []
+    try:
+        for rule in json.loads(cfg.get("aggregate_rules", "[]")):
+            functions = rule.get("functions", ["avg"])
+            for function in functions:
+                if function not in Aggregator.functions:
+                    raise ValueError("unknown function %s" % function)
+            # json gives unicode, which would make the labels unicode too
+            functions = [str(function) for function in functions]
+            window = int(rule.get("window", 60))
+            if window < 1:
+                raise ValueError("window needs to be at least 1")
+            rules.append((re.compile(rule["pattern"].encode("utf-8")),
+                          window, functions))
+        delay = int(cfg.get("aggregate_delay", 60))
+    except (ValueError, KeyError, TypeError, AttributeError, re.error) as ex:
+        log.critical("bad aggregate_rules or aggregate_delay: %s" % ex)
+        sys.exit(1)
+    if not rules:
+        log.critical("aggregate is on, but there are no aggregate_rules")
+        sys.exit(1)
+    try:
+        save_interval = float(cfg.get("aggregate_save_interval", 60))
+    except ValueError:
+        log.critical("aggregate_save_interval needs to be a number")
+        sys.exit(1)
+    aggregator = Aggregator(rules, delay, save_interval)
+    state_file = aggregate_state_file()
+    try:
+        aggregator.load(state_file)
+    except (IOError, OSError, EOFError, ValueError, TypeError,
+            pickle.UnpicklingError) as ex:
+        log.critical("can't read the aggregates from %s: %s" % (state_file,
+                                                                ex))
+        sys.exit(1)
+    log.info("aggregating metrics by %s rules, %s windows in progress" % (
+        len(rules), len(aggregator.slots)))
+
 
+def aggregate_state_file():
+    return cfg.get("aggregate_state_file",
+                   os.path.join(spool_directory, "_aggregate.state"))
 
-def check_skip_file(file_name, file_dir):
+
+def save_aggregates(force=False):
+    """
+    saves the windows in progress every aggregate_save_interval seconds
+    (def:60)
+    """
+    if aggregator is None:
+        return
+    if not force and time.time() - aggregator.saved < aggregator.save_interval:
+        return
+    try:
+        aggregator.save(aggregate_state_file())
+    except (IOError, OSError) as ex:
+        log.critical("can't save the aggregates to %s: %s" % (
+            aggregate_state_file(), ex))
+
+
+def send_aggregated():
+    """
+    sends the aggregates of the windows that are done. Backends that don't
+    take them all get them queued for retry, if they have a retry queue
+    """
+    if aggregator is None:
+        return
+    metrics = aggregator.flush(time.time())
+    stats.add("aggregate.points_in", aggregator.points_in)
+    stats.add("aggregate.points_out", len(metrics))
+    stats.add("aggregate.late", aggregator.late)
+    stats.add("aggregate.repeated", aggregator.repeated)
+    stats.add("aggregate.series", len(aggregator.slots))
+    aggregator.points_in = 0
+    aggregator.late = 0
+    aggregator.repeated = 0
+    if changes is not None:
+        metrics = changes.filter(metrics)
+    if not metrics:
+        return
+    processed_dict = send_backends(metrics)
+    for backend in be["essential_backends"]:
+        processed = processed_dict[backend]
+        if processed < len(metrics):
+            if not queue_metrics(backend, unsent_metrics(backend, metrics,
+                                                         processed)):
+                log.critical("%s didn't take %s aggregated metrics, they're "
+                             "lost" % (backend, len(metrics) - processed))
+
+
+class RateDeriver(object):
+    """
+    Turns counters (perfdata with a c unit of measure) into per second
+    rates, sent as <label>_rate next to the counter. The last two (TIMET,
+    value) of every counter are kept in arrays indexed by the counter's
+    slot, so a spool file that is sent again gets the same rates again.
+    A counter that went down wrapped around if the wrapped difference is
+    less than half its range (32 bit if it was below 2**32, else 64 bit),
+    otherwise it was reset and there's no rate until its next value.
+    Counters are known by the first 8 bytes of the md5 of their names, so
+    they're the same across restarts.
+
+    The table is saved to state_file now and then, and when graphios stops,
+    so a restart doesn't lose a rate. Counters not seen for max_age seconds
+    are let go when it's saved.
+    """
+    magic = "GRAPHIOS RATES 1\n"
+    header = struct.Struct("!Q")
+    max_age = 86400
+
+    def __init__(self, state_file, keep_counters, save_interval=60):
+        self.state_file = state_file
+        self.keep_counters = keep_counters
+        self.save_interval = save_interval
+        self.slots = {}  # hash of the counter: slot
+        self.keys = []
+        # times are doubles too, array has no 64 bit integers on python 2
+        self.last_t = array.array("d")
+        self.last_v = array.array("d")
+        self.prev_t = array.array("d")  # -1 if there's no previous value
+        self.prev_v = array.array("d")
+        self.saved = time.time()
+        self.changed = False
+
+    def key(self, m):
+        """
+        a hash of the counter that stays the same across restarts
+        """
+        return hashlib.md5("\t".join(metric_key(m))).digest()[:8]
+
+    def rate(self, t1, v1, t2, v2):
+        """
+        returns the per second rate from v1 at t1 to v2 at t2, None if the
+        counter was reset
+        """
+        delta = v2 - v1
+        if delta < 0:
+            if v1 < 2 ** 32:
+                delta += 2 ** 32
+                if delta >= 2 ** 31:
+                    return None
+            else:
+                delta += 2 ** 64
+                if delta >= 2 ** 63:
+                    return None
+        return delta / (t2 - t1)
+
+    def derive(self, metrics):
+        """
+        returns the metrics with the rates of the counters in them, and
+        without the counters unless keep_counters
+        """
+        out = []
+        for m in metrics:
+            if m.UOM != "c":
+                out.append(m)
+                continue
+            if self.keep_counters:
+                out.append(m)
+            try:
+                timet = int(m.TIMET)
+                value = float(m.VALUE)
+            except ValueError:
+                continue
+            rate = self.add(self.key(m), timet, value)
+            if rate is not None:
+                out.append(PerfMetric(metric_context(m),
+                                      "%s_rate" % m.LABEL, repr(rate), ""))
+        return out
+
+    def add(self, key, timet, value):
+        """
+        takes the counter's value, returns its rate or None
+        """
+        slot = self.slots.get(key)
+        if slot is None:
+            self.slots[key] = len(self.keys)
+            self.keys.append(key)
+            self.last_t.append(timet)
+            self.last_v.append(value)
+            self.prev_t.append(-1)
+            self.prev_v.append(0.0)
+            self.changed = True
+            return None
+        if timet == self.last_t[slot]:
+            # sent again
+            if self.prev_t[slot] < 0 or value != self.last_v[slot]:
+                return None
+            return self.rate(self.prev_t[slot], self.prev_v[slot],
+                             timet, value)
+        if timet < self.last_t[slot]:
+            return None
+        rate = self.rate(self.last_t[slot], self.last_v[slot], timet, value)
+        self.prev_t[slot] = self.last_t[slot]
+        self.prev_v[slot] = self.last_v[slot]
+        if rate is None:
+            # reset, start over from this value
+            self.prev_t[slot] = -1
+        self.last_t[slot] = timet
+        self.last_v[slot] = value
+        self.changed = True
+        return rate
+
+    def load(self):
+        """
+        reads the table back from state_file, if there is one
+        """
+        try:
+            state = open(self.state_file, "rb")
+        except IOError as ex:
+            if ex.errno != errno.ENOENT:
+                raise
+            return
+        try:
+            if state.read(len(self.magic)) != self.magic:
+                raise IOError("%s isn't a rates state file" % self.state_file)
+            (count,) = self.header.unpack(self.read(state, self.header.size))
+            keys = self.read(state, count * 8)
+            self.keys = [keys[i:i + 8] for i in xrange(0, len(keys), 8)]
+            for column in (self.last_t, self.last_v, self.prev_t,
+                           self.prev_v):
+                column.fromstring(self.read(state, count * column.itemsize))
+                if sys.byteorder == "big":
+                    column.byteswap()
+        finally:
+            state.close()
+        for slot in xrange(len(self.keys)):
+            self.slots[self.keys[slot]] = slot
+
+    def read(self, state, size):
+        """
+        reads size bytes of the state file, raises IOError if it's shorter
+        """
+        data = state.read(size)
+        if len(data) != size:
+            raise IOError("%s is truncated" % self.state_file)
+        return data
+
+    def save(self):
+        """
+        writes the table to state_file, leaving out the counters that
+        weren't seen for max_age seconds
+        """
+        oldest = time.time() - self.max_age
+        columns = (self.last_t, self.last_v, self.prev_t, self.prev_v)
+        keep = [slot for slot in xrange(len(self.keys))
+                if self.last_t[slot] >= oldest]
+        if len(keep) < len(self.keys):
+            self.keys = [self.keys[slot] for slot in keep]
+            for column in columns:
+                column[:] = array.array(column.typecode,
+                                        [column[slot] for slot in keep])
+            self.slots = {}
+            for slot in xrange(len(self.keys)):
+                self.slots[self.keys[slot]] = slot
+        tmp_file = "%s.tmp" % self.state_file
+        state = open(tmp_file, "wb")
+        try:
+            state.write(self.magic)
+            state.write(self.header.pack(len(self.keys)))
+            state.write("".join(self.keys))
+            for column in columns:
+                if sys.byteorder == "big":
+                    column = array.array(column.typecode, column)
+                    column.byteswap()
+                state.write(column.tostring())
+            state.flush()
+            os.fsync(state.fileno())
+        finally:
+            state.close()
+        os.rename(tmp_file, self.state_file)
+        self.saved = time.time()
+        self.changed = False
+
+
+def init_rates():
+    """
+    sets up the RateDeriver, with the table saved in rate_state_file
+    """
+    global rates
+    state_file = cfg.get("rate_state_file",
+                         os.path.join(spool_directory, "_rates.state"))
+    try:
+        save_interval = float(cfg.get("rate_save_interval", 60))
+    except ValueError:
+        log.critical("rate_save_interval needs to be a number")
+        sys.exit(1)
+    rates = RateDeriver(state_file,
+                        cfg.get("rate_keep_counters", True) is True,
+                        save_interval)
+    try:
+        rates.load()
+    except (IOError, OSError, struct.error, ValueError) as ex:
+        log.critical("can't read the rates from %s: %s" % (state_file, ex))
+        sys.exit(1)
+    log.info("deriving rates of counters, %s known" % len(rates.slots))
+
+
+def save_rates(force=False):
+    """
+    saves the rates table every rate_save_interval seconds (def:60)
+    """
+    if rates is None or not rates.changed:
+        return
+    if not force and time.time() - rates.saved < rates.save_interval:
+        return
+    try:
+        rates.save()
+    except (IOError, OSError) as ex:
+        log.critical("can't save the rates to %s: %s" % (rates.state_file,
+                                                         ex))
+
+
+def parse_files(file_dirs):
+    """
+    yields (file_dir, metrics) for each file, in order. With spool_workers
+    set the files are parsed in the worker pool, a few files ahead of the
+    one being sent, otherwise they are parsed here one at a time.
+    """
+    if cfg["spool_workers"] < 2:
+        for file_dir in file_dirs:
+            start = time.time()
+            mobjs = process_log(file_dir)
+            stats.add("parse_time", time.time() - start)
+            yield (file_dir, mobjs)
+        return
+    pending = collections.deque()
+    for file_dir in file_dirs:
+        pending.append(get_pool().apply_async(pool_process_log, (file_dir,)))
+        # don't let parsed files pile up while the backends are slow
+        if len(pending) >= cfg["spool_workers"] * 2:
+            yield check_pool_result(pending.popleft().get())
+    while pending:
+        yield check_pool_result(pending.popleft().get())
+
+
+def get_pool():
+    """
+    returns the spool worker pool, creating it on first use
+    """
+    global pool
+    if pool is None:
+        log.info("starting %s spool workers" % cfg["spool_workers"])
+        pool = multiprocessing.Pool(cfg["spool_workers"], init_worker)
+    return pool
+
+
+class WorkerLogHandler(logging.Handler):
+    """
+    Keeps what a spool worker logs, so the main process can log it. Only
+    the main process writes the log file, as the workers rotating it too
+    would lose lines.
+    """
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append((record.levelno, record.getMessage()))
+
+    def take(self):
+        records = self.records
+        self.records = []
+        return records
+
+
+def init_worker():
+    """
+    ctrl-c is handled by the main process, which terminates the pool (with
+    SIGTERM). The log lines go back to it too.
+    """
+    global worker_log
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    for handler in log.handlers[:]:
+        log.removeHandler(handler)
+    worker_log = WorkerLogHandler()
+    log.addHandler(worker_log)
+
+
+def pool_process_log(file_name):
+    """
+    process_log for the worker pool. A worker can't exit graphios, so a
+    file process_log would exit on comes back with None as its metrics.
+    """
+    start = time.time()
+    try:
+        mobjs = process_log(file_name)
+    except SystemExit:
+        return (file_name, None, 0, worker_log.take())
+    return (file_name, mobjs, time.time() - start, worker_log.take())
+
+
+def check_pool_result(result):
+    """
+    logs what the worker logged and exits like process_log does when it
+    couldn't read a file, returns (file_name, metrics)
+    """
+    (file_name, mobjs, elapsed, records) = result
+    for (level, message) in records:
+        log.log(level, message)
+    if mobjs is None:
+        log.critical("spool worker failed to process %s" % file_name)
+        sys.exit(2)
+    stats.add("parse_time", elapsed)
+    return (file_name, mobjs)
+
+
+def list_spool_dir(directory):
+    """
+    returns the spool files we'd process, oldest first going by the $TIMET$
+    the nagios commands add to the file name, as (timet, name, path, stat)
+    tuples where stat() returns the file's os.stat. With scandir the
+    directories are told apart without a stat, and the stat is cached.
+    """
+    spool_files = []
+    if scandir is not None:
+        for entry in scandir(directory):
+            if skip_file_name(entry.name) or entry.is_dir():
+                continue
+            spool_files.append((spool_timet(entry.name), entry.name,
+                                entry.path, entry.stat))
+    else:
+        for name in os.listdir(directory):
+            if skip_file_name(name):
+                continue
+            path = os.path.join(directory, name)
+            spool_files.append((spool_timet(name), name, path,
+                                lambda path=path: os.stat(path)))
+    spool_files.sort(key=lambda spool_file: spool_file[:2])
+    return spool_files
+
+
+def spool_timet(file_name):
+    """
+    the $TIMET$ at the end of a spool file's name, 0 if it hasn't got one
+    """
+    timet = file_name.rsplit(".", 1)[-1]
+    if timet.isdigit():
+        return int(timet)
+    return 0
+
+
+def pick_spool_files(spool_files):
     """
-    checks if file should be skipped
+    returns the paths of the spool files to process this pass, oldest first,
+    and how many are left for the next pass. That's all of them, unless
+    spool_max_files or spool_max_size (megabytes) cap a pass. Then every
+    fourth file is taken from the newest end, so a backlog drains oldest
+    first without holding up the fresh metrics. Not with aggregate or rates
+    on though, they need the points in time order. Empty files are removed,
+    and anything that isn't a file skipped.
+    """
+    max_files = cfg.get("spool_max_files", 0)
+    max_bytes = cfg.get("spool_max_size", 0) * 1024 * 1024
+    # take from the newest end too
+    fresh = aggregator is None and rates is None
+    picked = []  # (index in spool_files, path)
+    picked_bytes = 0
+    oldest = 0
+    newest = len(spool_files) - 1
+    while oldest <= newest:
+        if fresh and len(picked) % 4 == 3:
+            i = newest
+            newest -= 1
+        else:
+            i = oldest
+            oldest += 1
+        path = spool_files[i][2]
+        try:
+            st = spool_files[i][3]()
+        except OSError:
+            # gone already
+            continue
+        if not stat.S_ISREG(st.st_mode):
+            continue
+        if st.st_size == 0:
+            handle_file(path, 0)
+            continue
+        if picked and (
+                (max_files > 0 and len(picked) >= max_files) or
+                (max_bytes > 0 and picked_bytes + st.st_size > max_bytes)):
+            # this one's left as well
+            return ([picked_file[1] for picked_file in sorted(picked)],
+                    newest - oldest + 2)
+        picked.append((i, path))
+        picked_bytes += st.st_size
+    return ([picked_file[1] for picked_file in sorted(picked)], 0)
+
+
+def skip_file_name(file_name):
+    """
+    checks if a file should be skipped by its name alone: the files nagios
+    is still writing, and files starting with _
     """
     if (
         file_name == "host-perfdata" or
@@ -491,16 +1755,94 @@ def check_skip_file(file_name, file_dir):
         return True
     elif re.match('^_', file_name):
         return True
-
-    if os.stat(file_dir)[6] == 0:
-        # file was 0 bytes
-        handle_file(file_dir, 0)
-        return True
-    if os.path.isdir(file_dir):
-        return True
     return False
 
 
+class SpoolWatcher(object):
+    """
+    Waits for perfdata files to show up in the spool directory. On linux it
+    uses inotify (through ctypes) to wake up as soon as nagios moves a file
+    in, elsewhere, or if inotify can't be set up, it just sleeps.
+    """
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_Q_OVERFLOW = 0x00004000
+    event_header = struct.Struct("iIII")
+
+    def __init__(self, directory, mode="auto"):
+        self.fd = None
+        if mode == "poll":
+            log.info("polling %s for perfdata files" % directory)
+            return
+        try:
+            self.fd = self.inotify_init(directory)
+        except (OSError, AttributeError) as ex:
+            if mode == "inotify":
+                log.critical("can't watch %s with inotify: %s" % (
+                             directory, ex))
+                sys.exit(1)
+            log.info("inotify not available (%s), polling %s for perfdata "
+                     "files" % (ex, directory))
+        else:
+            log.info("watching %s for perfdata files with inotify" %
+                     directory)
+
+    def inotify_init(self, directory):
+        libc_name = ctypes.util.find_library("c")
+        if libc_name is None:
+            raise OSError("can't find libc")
+        libc = ctypes.CDLL(libc_name, use_errno=True)
+        fd = libc.inotify_init()
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init failed")
+        wd = libc.inotify_add_watch(fd, directory,
+                                    self.IN_MOVED_TO | self.IN_CLOSE_WRITE)
+        if wd < 0:
+            err = ctypes.get_errno()
+            os.close(fd)
+            raise OSError(err, "inotify_add_watch failed")
+        return fd
+
+    def wait(self, timeout):
+        """
+        returns when a new perfdata file arrived or after timeout seconds
+        """
+        if self.fd is None:
+            time.sleep(timeout)
+            return
+        deadline = time.time() + timeout
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return
+            try:
+                readable = select.select([self.fd], [], [], remaining)[0]
+            except select.error as ex:
+                if ex.args[0] == errno.EINTR:
+                    continue
+                raise
+            if readable and self.new_files(os.read(self.fd, 65536)):
+                return
+
+    def new_files(self, events):
+        """
+        checks if the inotify events are for files we'd process
+        """
+        offset = 0
+        while offset + self.event_header.size <= len(events):
+            (wd, mask, cookie, length) = self.event_header.unpack_from(
+                events, offset)
+            offset += self.event_header.size
+            name = events[offset:offset + length].rstrip("\0")
+            offset += length
+            if mask & self.IN_Q_OVERFLOW:
+                return True
+            if name and not skip_file_name(name):
+                log.debug("%s arrived in the spool directory" % name)
+                return True
+        return False
+
+
 def init_backends():
     """
     I'm going to be a little forward thinking with this and build a global dict
@@ -515,6 +1857,9 @@ def init_backends():
     be = {}  # a top-level global for important backend-related stuff
     be["enabled_backends"] = {}  # a dict of instantiated backend objects
     be["essential_backends"] = []  # a list of backends we actually care about
+    be["send_timeouts"] = {}  # seconds to wait for each backend's send
+    be["sending"] = {}  # sends that timed out and are still running
+    be["retry_queues"] = {}  # RetryQueue of each essential backend
     # PLUGIN WRITERS! register your new backends by adding their obj name here
     avail_backends = ("carbon",
                       "statsd",
@@ -537,36 +1882,412 @@ def init_backends():
                     be["essential_backends"].append(backend)
             else:
                 be["essential_backends"].append(backend)
+            be["send_timeouts"][backend] = get_send_timeout(backend)
     # not proud of that slovenly conditional ^^
+    if cfg.get("retry_queue") is True and not cfg.get("test_mode"):
+        init_retry_queues()
+    if cfg.get("aggregate") is True:
+        init_aggregator()
+    if cfg.get("dedup") is True:
+        init_dedup()
+    if cfg.get("rates") is True:
+        init_rates()
+    if cfg.get("changes_only") is True:
+        init_changes()
+    if cfg.get("thresholds") is True:
+        init_thresholds()
+    be["threaded_sends"] = (
+        len(be["enabled_backends"]) > 1 or
+        len([t for t in be["send_timeouts"].values() if t is not None]) > 0
+    )
     log.info("Enabled backends: %s" % be["enabled_backends"].keys())
 
 
-def send_backends(metrics):
+def init_retry_queues():
+    """
+    sets up a RetryQueue for each essential backend
+    """
+    directory = cfg.get("retry_queue_directory",
+                        os.path.join(spool_directory, "_retry"))
+    try:
+        max_size = int(cfg.get("retry_queue_max_size", 256)) * 1024 * 1024
+    except ValueError:
+        log.critical("retry_queue_max_size needs to be a integer")
+        sys.exit(1)
+    for backend in be["essential_backends"]:
+        try:
+            be["retry_queues"][backend] = RetryQueue(
+                os.path.join(directory, backend), max_size)
+        except (IOError, OSError) as ex:
+            log.critical("can't set up the retry queue for %s in %s: %s" % (
+                         backend, directory, ex))
+            sys.exit(1)
+        log.info("retry queue for %s: %s bytes queued" % (
+                 backend, be["retry_queues"][backend].size()))
+
+
+def init_dedup():
+    """
+    sets up the Deduplicator, remembering dedup_window seconds of points
+    """
+    global dedup
+    try:
+        window = int(cfg.get("dedup_window", 600))
+    except ValueError:
+        log.critical("dedup_window needs to be a integer")
+        sys.exit(1)
+    dedup = Deduplicator(window)
+    log.info("dropping points the backends already took, for %ss" % window)
+
+
+class Deduplicator(object):
     """
-    use the enabled_backends dict to call into the backend send functions
+    Remembers which backends took which points, a point being a metric at a
+    TIMET, so the points of a spool file that is sent again (because some
+    other backend didn't take them) only go to the backends that haven't got
+    them yet. Points are kept as {hash of the point: bitmask of backends}
+    per minute of their TIMET, and the minutes that are more than window
+    seconds older than the newest point are let go. Older points are always
+    sent.
+    """
+    def __init__(self, window):
+        self.window = window
+        self.bits = {}  # backend: its bit in the masks
+        self.buckets = {}  # minute: {hash of a point: backends mask}
+        self.newest = 0  # newest minute seen
+
+    def bit(self, backend):
+        if backend not in self.bits:
+            self.bits[backend] = 1 << len(self.bits)
+        return self.bits[backend]
+
+    def points(self, metrics):
+        """
+        returns the (minute, hash) of each metric's point, None for points
+        that can't be told apart
+        """
+        points = []
+        for m in metrics:
+            c = metric_context(m)
+            try:
+                minute = int(c.TIMET) // 60
+            except ValueError:
+                points.append(None)
+                continue
+            points.append((minute, hash(metric_key(m) + (c.TIMET,))))
+        return points
+
+    def unsent(self, backend, metrics, points):
+        """
+        returns the metrics the backend hasn't taken yet
+        """
+        bit = self.bit(backend)
+        unsent = []
+        for i in xrange(len(metrics)):
+            if points[i] is not None:
+                bucket = self.buckets.get(points[i][0])
+                if bucket is not None and bucket.get(points[i][1], 0) & bit:
+                    continue
+            unsent.append(metrics[i])
+        return unsent
+
+    def took(self, backend, metrics, points, missed):
+        """
+        remembers that the backend took the metrics, but for the ids in
+        missed
+        """
+        bit = self.bit(backend)
+        oldest = self.newest - self.window // 60
+        for i in xrange(len(metrics)):
+            if points[i] is None or id(metrics[i]) in missed:
+                continue
+            (minute, point) = points[i]
+            if minute < oldest:
+                continue
+            bucket = self.buckets.get(minute)
+            if bucket is None:
+                bucket = self.buckets[minute] = {}
+            bucket[point] = bucket.get(point, 0) | bit
+            if minute > self.newest:
+                self.newest = minute
+                oldest = self.newest - self.window // 60
+        for minute in self.buckets.keys():
+            if minute < oldest:
+                del self.buckets[minute]
+
+    def __len__(self):
+        return sum([len(bucket) for bucket in self.buckets.values()])
+
+
+def init_changes():
+    """
+    sets up the ChangeFilter, sending unchanged values every
+    changes_heartbeat seconds
+    """
+    global changes
+    try:
+        heartbeat = int(cfg.get("changes_heartbeat", 600))
+    except ValueError:
+        log.critical("changes_heartbeat needs to be a integer")
+        sys.exit(1)
+    changes = ChangeFilter(heartbeat)
+    log.info("only sending values that changed, or every %ss" % heartbeat)
+
+
+class ChangeFilter(object):
+    """
+    Drops the values that are the same as the last one sent for their
+    metric, unless that was heartbeat seconds ago or more. The last value
+    and TIMET sent are kept in arrays indexed by the metric's slot, found by
+    the hash of the metric. A value from the same TIMET as the last one sent
+    is sent again, as its spool file is being sent again, and values older
+    than that are always sent. Values that aren't numbers are always sent.
+    Metrics last sent more than heartbeat seconds ago are forgotten every
+    heartbeat seconds, their next value is sent anyway.
+    """
+    def __init__(self, heartbeat):
+        self.heartbeat = heartbeat
+        self.slots = {}  # hash of the metric: slot
+        self.last_t = array.array("d")
+        self.last_v = array.array("d")
+        self.pruned = time.time()
+
+    def keep(self, m):
+        """
+        returns True if the metric is to be sent
+        """
+        c = metric_context(m)
+        try:
+            timet = int(c.TIMET)
+            value = float(m.VALUE)
+        except ValueError:
+            return True
+        key = hash(metric_key(m))
+        slot = self.slots.get(key)
+        if slot is None:
+            self.slots[key] = len(self.last_t)
+            self.last_t.append(timet)
+            self.last_v.append(value)
+        elif timet <= self.last_t[slot]:
+            pass
+        elif (value != self.last_v[slot] or
+              timet - self.last_t[slot] >= self.heartbeat):
+            self.last_t[slot] = timet
+            self.last_v[slot] = value
+        else:
+            return False
+        return True
+
+    def filter(self, metrics):
+        """
+        returns the metrics that are to be sent
+        """
+        kept = [m for m in metrics if self.keep(m)]
+        stats.add("changes.suppressed", len(metrics) - len(kept))
+        return kept
+
+    def prune(self, now):
+        """
+        forgets the metrics last sent more than heartbeat seconds before now,
+        if it's been heartbeat seconds since it last did
+        """
+        if now - self.pruned < self.heartbeat:
+            return
+        oldest = now - self.heartbeat
+        slots = {}
+        last_t = array.array("d")
+        last_v = array.array("d")
+        for (key, slot) in self.slots.iteritems():
+            if self.last_t[slot] >= oldest:
+                slots[key] = len(last_t)
+                last_t.append(self.last_t[slot])
+                last_v.append(self.last_v[slot])
+        self.slots = slots
+        self.last_t = last_t
+        self.last_v = last_v
+        self.pruned = now
+
+
+def get_send_timeout(backend):
+    """
+    returns the <backend>_send_timeout or send_timeout in seconds, None for
+    no timeout
+    """
+    timeout = cfg.get("%s_send_timeout" % backend, cfg.get("send_timeout", 0))
+    try:
+        timeout = float(timeout)
+    except ValueError:
+        log.critical("%s_send_timeout needs to be a number" % backend)
+        sys.exit(1)
+    if timeout <= 0:
+        return None
+    return timeout
+
+
+class BackendSend(threading.Thread):
+    """
+    runs one backend's send() so the backends can send at the same time
+    """
+    def __init__(self, backend, backend_obj, metrics):
+        threading.Thread.__init__(self, name="send-%s" % backend)
+        self.daemon = True
+        self.backend_obj = backend_obj
+        self.metrics = metrics
+        self.processed = 0
+        self.elapsed = 0
+        self.exc_info = None
+
+    def run(self):
+        start = time.time()
+        try:
+            self.processed = self.backend_obj.send(self.metrics)
+        except BaseException:
+            # re-raised in the main thread by send_backends
+            self.exc_info = sys.exc_info()
+        self.elapsed = time.time() - start
+
+
+def send_backends(metrics, backend_names=None):
+    """
+    use the enabled_backends dict to call into the backend send functions,
+    or just the ones in backend_names.
+    With more than one backend, or a send timeout, every backend sends in
+    its own thread. A backend that doesn't finish within its timeout counts
+    as having processed 0 metrics, and is skipped until that send is done.
+    With dedup on, each backend only gets the points it hasn't taken yet,
+    and the rest count as processed.
     """
     global be
     if len(be["enabled_backends"]) < 1:
         log.critical("At least one Back-end must be enabled in graphios.cfg")
         sys.exit(1)
+    if backend_names is None:
+        backend_names = be["enabled_backends"].keys()
     ret = {}  # return a dict of who processed what
     processed_lines = 0
-    for backend in be["enabled_backends"]:
-        processed_lines = be["enabled_backends"][backend].send(metrics)
-        # log.debug('%s processed %s metrics' % backend, processed_lines)
-        ret[backend] = processed_lines
+    points = None
+    to_send = {}  # backend: the metrics it gets
+    if dedup is not None:
+        points = dedup.points(metrics)
+    for backend in backend_names:
+        if points is None:
+            to_send[backend] = metrics
+        else:
+            to_send[backend] = dedup.unsent(backend, metrics, points)
+    if not be["threaded_sends"]:
+        for backend in backend_names:
+            start = time.time()
+            processed_lines = be["enabled_backends"][backend].send(
+                to_send[backend])
+            ret[backend] = took_metrics(backend, metrics, to_send[backend],
+                                        processed_lines, points)
+            record_send(backend, to_send[backend], processed_lines,
+                        time.time() - start)
+        return ret
+    threads = {}
+    start = time.time()
+    for backend in backend_names:
+        if backend in be["sending"]:
+            if be["sending"][backend].is_alive():
+                log.warning("%s is still busy with an earlier send, "
+                            "skipping it" % backend)
+                ret[backend] = 0
+                record_send(backend, metrics, 0, 0)
+                continue
+            del be["sending"][backend]
+        threads[backend] = BackendSend(backend,
+                                       be["enabled_backends"][backend],
+                                       to_send[backend])
+        threads[backend].start()
+    for backend in threads:
+        thread = threads[backend]
+        timeout = be["send_timeouts"][backend]
+        if timeout is None:
+            thread.join()
+        else:
+            thread.join(max(start + timeout - time.time(), 0))
+        if thread.is_alive():
+            log.critical("%s didn't finish sending within %ss" % (backend,
+                                                                  timeout))
+            be["sending"][backend] = thread
+            ret[backend] = 0
+            record_send(backend, metrics, 0, timeout)
+        elif thread.exc_info is not None:
+            raise thread.exc_info[0], thread.exc_info[1], thread.exc_info[2]
+        else:
+            ret[backend] = took_metrics(backend, metrics, to_send[backend],
+                                        thread.processed, points)
+            record_send(backend, to_send[backend], thread.processed,
+                        thread.elapsed)
     return ret
 
 
+def took_metrics(backend, metrics, sent, processed, points):
+    """
+    returns how many of the metrics a backend has taken: what it processed
+    of the ones it was sent, plus the ones dedup didn't send it because it
+    took them before. With dedup on, remembers the ones it took.
+    """
+    if points is None:
+        return processed
+    stats.add("%s.duplicates_dropped" % backend, len(metrics) - len(sent))
+    if processed >= len(sent):
+        dedup.took(backend, metrics, points, ())
+    else:
+        unsent = unsent_metrics(backend, sent, processed)
+        # unless it can't tell which it took
+        if unsent is not sent:
+            dedup.took(backend, metrics, points,
+                       set([id(m) for m in unsent]))
+    return processed + len(metrics) - len(sent)
+
+
+def record_send(backend, metrics, processed, elapsed):
+    """
+    adds a backend's send to the self metrics
+    """
+    stats.add("%s.send_time" % backend, elapsed)
+    stats.add("%s.convert_time" % backend,
+              getattr(be["enabled_backends"][backend], "convert_time", 0))
+    stats.add("%s.metrics_sent" % backend, processed)
+    if processed < len(metrics):
+        stats.add("%s.send_failures" % backend, 1)
+
+
+def stop(signum, frame):
+    """
+    SIGTERM (from the init script or systemd) exits like ctrl-c does, so
+    the state is saved
+    """
+    raise KeyboardInterrupt()
+
+
 def main():
     log.info("graphios startup.")
+    signal.signal(signal.SIGTERM, stop)
+    watcher = SpoolWatcher(spool_directory, cfg.get("spool_watch", "auto"))
+    sleep_time = float(cfg["sleep_time"])
+    sleep_max = float(cfg["sleep_max"])
+    wait_time = sleep_time
     try:
         while True:
-            process_spool_dir(spool_directory)
+            kept = process_spool_dir(spool_directory)
+            # back off while the backends are failing
+            if kept > 0:
+                wait_time = min(wait_time * 2, sleep_max)
+            else:
+                wait_time = sleep_time
+                if deferred_files > 0 and not cfg.get("test_mode"):
+                    # more spool files waiting, carry on with those
+                    continue
             log.debug("graphios sleeping.")
-            time.sleep(float(cfg["sleep_time"]))
+            watcher.wait(wait_time)
     except KeyboardInterrupt:
-        log.info("ctrl-c pressed. Exiting graphios.")
+        log.info("ctrl-c pressed or SIGTERM received. Exiting graphios.")
+        if pool is not None:
+            pool.terminate()
+        save_aggregates(force=True)
+        save_rates(force=True)
 
 
 if __name__ == '__main__':
@@ -1,19 +1,130 @@
 # vim: set ts=4 sw=4 tw=79 et :
 
+import bisect
 import socket
 import cPickle as pickle
+import string
 import struct
 import re
+import select
 import logging
 import sys
 import base64
-import urllib2
+import urllib
 import json
 import os
 import datetime
+import threading
+import time
 import urllib3
+import zlib
+from hashlib import md5
 from statsd import StatsClient, TCPStatsClient
 from influxdb import InfluxDBClient
+
+
+# ###########################################################
+# #### Path cache, shared by the backends
+
+class PathCache(object):
+    """
+    A bounded cache of built metric paths, keyed on the metric fields the
+    path is made of. The set of paths a nagios install produces hardly ever
+    changes, so once warm, building a path is a dict lookup.
+
+    It's an approximate LRU with two generations: paths are added to the
+    current generation, and when that holds size paths it becomes the old
+    generation and the one before is dropped. A path found in the old
+    generation moves back to the current one, so the paths in use survive.
+    """
+    def __init__(self, size):
+        self.size = size
+        self.current = {}
+        self.old = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        path = self.current.get(key)
+        if path is not None:
+            self.hits += 1
+            return path
+        path = self.old.get(key)
+        if path is not None:
+            self.hits += 1
+            self.put(key, path)
+            return path
+        self.misses += 1
+        return None
+
+    def put(self, key, path):
+        if self.size <= 0:
+            return
+        if len(self.current) >= self.size:
+            self.old = self.current
+            self.current = {}
+        self.current[key] = path
+
+    def __len__(self):
+        return len(self.current) + len(self.old)
+
+
+def get_path_cache(cfg, log):
+    """
+    returns a PathCache of path_cache_size paths (def: 100000, 0 disables)
+    """
+    try:
+        return PathCache(int(cfg.get('path_cache_size', 100000)))
+    except ValueError:
+        log.critical("path_cache_size needs to be a integer")
+        sys.exit(1)
+
+
+class Whitelist(object):
+    """
+    Decides if metric keys are whitelisted, ie. searched by any of a list of
+    regular expressions (or plain substrings, with literal). The patterns are
+    joined into one alternation, so a key is searched once however many
+    patterns there are, and the decision for each key is remembered in a
+    PathCache. Patterns with inline flags or backreferences would mean
+    something else in the alternation, so with any of those the patterns
+    are searched in turn.
+    """
+    # \1, (?P=name) and (?(1)...), or an escaped backslash before a digit
+    group_refs = re.compile(r"\\[1-9]|\(\?P=|\(\?\(")
+
+    def __init__(self, patterns, cache, literal=False):
+        if literal:
+            patterns = [re.escape(pattern) for pattern in patterns]
+        # compiled one by one as well, so a bad pattern raises re.error
+        self.patterns = [re.compile(pattern) for pattern in patterns]
+        self.pattern = None
+        if self.patterns and not [
+                p for p in self.patterns
+                if p.flags or self.group_refs.search(p.pattern)]:
+            try:
+                self.pattern = re.compile("|".join(
+                    ["(?:%s)" % pattern for pattern in patterns]))
+            except (re.error, AssertionError, OverflowError):
+                # eg. more than 100 groups between them, search them in turn
+                pass
+        self.cache = cache
+
+    def match(self, key):
+        found = self.cache.get(key)
+        if found is None:
+            if self.pattern is not None:
+                found = self.pattern.search(key) is not None
+            else:
+                found = False
+                for pattern in self.patterns:
+                    if pattern.search(key) is not None:
+                        found = True
+                        break
+            self.cache.put(key, found)
+        return found
+
+
 # ###########################################################
 # #### Librato Backend
 
@@ -27,14 +138,18 @@ class librato(object):
 
         self.log = logging.getLogger("log.backends.librato")
         self.log.info("Librato Backend Initialized")
+        self.convert_time = 0  # seconds the last send spent converting
         self.api = "https://metrics-api.librato.com"
         self.sink_name = "graphios-librato"
         self.sink_version = "0.0.1"
         self.flush_timeout_secs = 5
         self.gauges = {}
-        self.whitelist = []
+        self.gauge_metrics = {}  # the metrics behind each gauge
+        self.unsent = []  # metrics whose gauges the last send didn't deliver
+        self.whitelist = None
         self.metrics_sent = 0
         self.max_metrics_payload = 500
+        self.path_cache = get_path_cache(cfg, self.log)
 
         try:
             cfg["librato_email"]
@@ -72,21 +187,62 @@ class librato(object):
         except:
             self.floor_time_secs = 15
         else:
-            self.floor_time_secs = cfg["librato_floor_time_secs"]
+            try:
+                self.floor_time_secs = int(cfg["librato_floor_time_secs"])
+            except ValueError:
+                self.log.critical("librato_floor_time_secs needs to be a "
+                                  "integer")
+                sys.exit(1)
 
         try:
             cfg["librato_whitelist"]
         except:
-            self.whitelist = [re.compile(".*")]
+            patterns = [".*"]
         else:
-            for pattern in json.loads(cfg["librato_whitelist"]):
+            patterns = json.loads(cfg["librato_whitelist"])
+            for pattern in patterns:
                 self.log.debug("adding librato whitelist pattern %s" % pattern)
-                self.whitelist.append(re.compile(pattern))
+        try:
+            self.whitelist = Whitelist(patterns, get_path_cache(cfg, self.log))
+        except re.error as ex:
+            self.log.critical("bad librato_whitelist pattern: %s" % ex)
+            sys.exit(1)
+
+        self.api = cfg.get("librato_api", self.api)
+        try:
+            self.flush_timeout_secs = float(cfg.get("librato_timeout",
+                                                    self.flush_timeout_secs))
+            self.concurrency = int(cfg.get("librato_concurrency", 4))
+        except ValueError:
+            self.log.critical("librato_timeout and librato_concurrency need "
+                              "to be numbers")
+            sys.exit(1)
+        self.gzip = cfg.get("librato_gzip", False) is True
+
+        self.headers = {
+            'Content-Type': 'application/json',
+            'User-Agent': self.build_user_agent(),
+            'Authorization': 'Basic %s' % self.build_basic_auth()
+        }
+        if self.gzip:
+            self.headers['Content-Encoding'] = 'gzip'
+        # up to librato_concurrency connections, kept alive between flushes
+        self.pool = urllib3.connection_from_url(
+            self.api, maxsize=max(self.concurrency, 1), block=True,
+            timeout=self.flush_timeout_secs, retries=False)
 
     def build_path(self, vals, m):
+        key = tuple([getattr(m, s) for s in vals])
+        path = self.path_cache.get(key)
+        if path is None:
+            path = self.make_path(key)
+            self.path_cache.put(key, path)
+        return path
+
+    def make_path(self, values):
         path = ''
-        for s in vals:
-            path += getattr(m, s)
+        for value in values:
+            path += value
             path += '.'
         path = re.sub(r"^\.", '', path)  # fix sources that begin in dot
         path = re.sub(r"\.$", '', path)  # fix sources that end in dot
@@ -96,11 +252,7 @@ class librato(object):
 
     def k_not_in_whitelist(self, k):
         # return True if k isn't whitelisted
-        # wl_match = True
-        for pattern in self.whitelist:
-            if pattern.search(k) is not None:
-                return False
-        return True
+        return not self.whitelist.match(k)
 
     def add_measure(self, m):
         ts = int(m.TIMET)
@@ -116,77 +268,97 @@ class librato(object):
         if self.k_not_in_whitelist(k):
             return None
 
-        # add the metric to our gauges dict
-        if k not in self.gauges:
-            self.gauges[k] = {
+        try:
+            value = float(m.VALUE)
+        except ValueError:
+            self.log.debug("skipping non numeric metric %s %s" % (k, m.VALUE))
+            return None
+
+        # add the metric to our gauges dict, one gauge per time
+        gk = (k, ts)
+        if gk not in self.gauges:
+            self.gauges[gk] = {
                 'name': name,
                 'source': source,
                 'measure_time': ts,
             }
+            self.gauge_metrics[gk] = []
 
-        value = float(m.VALUE)
-        self.gauges[k]['value'] = value
+        self.gauges[gk]['value'] = value
+        self.gauge_metrics[gk].append(m)
 
-    def flush_payload(self, headers, g):
+    def flush_payload(self, g):
         """
-        POST a payload to Librato.
+        POST a payload to Librato, returns True if it took it.
         """
         body = json.dumps({'gauges': g})
-        url = "%s/v1/metrics" % (self.api)
-        req = urllib2.Request(url, body, headers)
+        if self.gzip:
+            gzipper = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            body = gzipper.compress(body) + gzipper.flush()
 
         try:
-            f = urllib2.urlopen(req, timeout=self.flush_timeout_secs)
-            # f.read()
-            f.close()
-        except urllib2.HTTPError as error:
-            self.metrics_sent = 0
-            body = error.read()
-            self.log.warning('Failed to send metrics to Librato: Code: \
-                                %d . Response: %s' % (error.code, body))
-        except IOError as error:
-            self.metrics_sent = 0
-            if hasattr(error, 'reason'):
-                self.log.warning('Error when sending metrics Librato \
-                                    (%s)' % (error.reason))
-            elif hasattr(error, 'code'):
-                self.log.warning('Error when sending metrics Librato \
-                                    (%s)' % (error.code))
-            else:
-                self.log.warning('Error when sending metrics Librato \
-                                    and I dunno why')
+            response = self.pool.urlopen('POST', '/v1/metrics', body=body,
+                                         headers=self.headers)
+        except (urllib3.exceptions.HTTPError, socket.error) as error:
+            self.log.warning('Error when sending metrics Librato (%s)' % (
+                             error))
+            return False
+        if response.status // 100 != 2:
+            self.log.warning('Failed to send metrics to Librato: Code: '
+                             '%d . Response: %s' % (response.status,
+                                                    response.data))
+            return False
+        return True
 
     def flush(self):
         """
-        POST a collection of gauges to Librato.
+        POST a collection of gauges to Librato, max_metrics_payload gauges at
+        a time, librato_concurrency payloads at once. The gauges are let go
+        either way, returns the metrics behind the gauges that didn't make
+        it.
         """
         # Nothing to do
         if len(self.gauges) == 0:
-            return 0
+            return []
 
-        # Limit our payload sizes
-        # max_metrics_payload = 500  # this is never used, delete it?
-
-        headers = {
-            'Content-Type': 'application/json',
-            'User-Agent': self.build_user_agent(),
-            'Authorization': 'Basic %s' % self.build_basic_auth()
-        }
-
-        metrics = []
-        count = 0
-        for g in self.gauges.values():
-            metrics.append(g)
-            count += 1
-
-            if count >= self.max_metrics_payload:
-                self.flush_payload(headers, metrics)
-                count = 0
-                metrics = []
-
-        if count > 0:
-            self.flush_payload(headers, metrics)
-            self.gauges = {}
+        gauges = self.gauges
+        gauge_metrics = self.gauge_metrics
+        self.gauges = {}
+        self.gauge_metrics = {}
+        keys = gauges.keys()
+        payloads = [keys[i:i + self.max_metrics_payload] for i in
+                    xrange(0, len(keys), self.max_metrics_payload)]
+        unsent = []
+        lock = threading.Lock()
+
+        def post_payload(payload):
+            if not self.flush_payload([gauges[k] for k in payload]):
+                with lock:
+                    for k in payload:
+                        unsent.extend(gauge_metrics[k])
+
+        if len(payloads) == 1 or self.concurrency < 2:
+            for payload in payloads:
+                post_payload(payload)
+            return unsent
+
+        def post_payloads():
+            while True:
+                with lock:
+                    if not payloads:
+                        return
+                    payload = payloads.pop()
+                post_payload(payload)
+
+        threads = []
+        for i in xrange(min(self.concurrency, len(payloads))):
+            thread = threading.Thread(target=post_payloads)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        return unsent
 
     def build_basic_auth(self):
 
@@ -205,20 +377,22 @@ class librato(object):
             system = os.name()
 
         pver = sys.version_info
-        user_agent = '%s/%s (%s) Python-Urllib2/%d.%d' % \
+        user_agent = '%s/%s (%s) Python-urllib3/%d.%d' % \
                      (sink_name, sink_version,
                       system, pver[0], pver[1])
         return user_agent
 
     def send(self, metrics):
 
-        self.metrics_sent = len(metrics)
         # Construct the output
+        start = time.time()
         for m in metrics:
             self.add_measure(m)
+        self.convert_time = time.time() - start
 
-        # Flush
-        self.flush()
+        # Flush. Metrics that weren't whitelisted or numbers count as sent
+        self.unsent = self.flush()
+        self.metrics_sent = len(metrics) - len(self.unsent)
 
         return self.metrics_sent
 
@@ -226,10 +400,156 @@ class librato(object):
 ############################################################
 # #### Carbon back-end #####
 
+class CarbonConnection(object):
+    """
+    A long lived connection to one carbon server. It is kept open across
+    sends, and after a failure it is reconnected with exponential backoff.
+    The server address is resolved at most once every dns_ttl seconds.
+    """
+    backoff_min = 1
+
+    def __init__(self, server, port, timeout, dns_ttl, backoff_max):
+        self.log = logging.getLogger("log.backends.carbon")
+        self.server = server
+        self.port = port
+        self.timeout = timeout
+        self.dns_ttl = dns_ttl
+        self.backoff_max = backoff_max
+        self.backoff = 0
+        self.next_attempt = 0
+        self.addr = None
+        self.addr_expires = 0
+        self.sock = None
+
+    def __str__(self):
+        return "%s:%s" % (self.server, self.port)
+
+    def resolve(self):
+        now = time.time()
+        if self.addr is None or now >= self.addr_expires:
+            self.addr = socket.gethostbyname(self.server)
+            self.addr_expires = now + self.dns_ttl
+        return self.addr
+
+    def connect(self):
+        """
+        returns True if there is a usable connection, connecting if needed
+        """
+        if self.sock is not None:
+            if not self.peer_closed():
+                return True
+            self.log.info("carbon at %s closed the connection" % self)
+            self.close()
+        if time.time() < self.next_attempt:
+            self.log.debug("not reconnecting to carbon at %s for %.0fs" % (
+                           self, self.next_attempt - time.time()))
+            return False
+        self.log.debug("Connecting to carbon at %s" % self)
+        sock = None
+        try:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            sock.settimeout(self.timeout)
+            sock.connect((self.resolve(), self.port))
+        except socket.error as ex:
+            self.log.warning("Can't connect to carbon: %s %s" % (self, ex))
+            if sock is not None:
+                sock.close()
+            self.failed()
+            return False
+        self.log.debug("connected")
+        self.sock = sock
+        self.backoff = 0
+        return True
+
+    def peer_closed(self):
+        """
+        carbon never writes to us, so a readable socket means it went away
+        """
+        try:
+            readable = select.select([self.sock], [], [], 0)[0]
+            return bool(readable) and self.sock.recv(1) == ''
+        except (select.error, socket.error):
+            return True
+
+    def failed(self):
+        """
+        drops the connection and schedules the next reconnect
+        """
+        self.close()
+        # the address may be what changed, look it up again next time
+        self.addr = None
+        self.backoff = min(max(self.backoff * 2, self.backoff_min),
+                           self.backoff_max)
+        self.next_attempt = time.time() + self.backoff
+
+    def sendall(self, data):
+        self.sock.sendall(data)
+
+    def close(self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except socket.error:
+                pass
+            self.sock = None
+
+
+class ConsistentHashRing(object):
+    """
+    The consistent hash ring of carbon-relay's consistent-hashing
+    RELAY_METHOD (carbon.hashing), so a metric goes to the same carbon-cache
+    it would get through the relay. Like carbon 1.0 and up, a replica
+    whose position is taken moves up to the next free one.
+    """
+    def __init__(self, nodes, replica_count=100):
+        self.ring = []
+        self.positions = set()
+        self.nodes = set()
+        self.replica_count = replica_count
+        for node in nodes:
+            self.add_node(node)
+
+    def compute_ring_position(self, key):
+        return int(md5(str(key)).hexdigest()[:4], 16)
+
+    def add_node(self, node):
+        self.nodes.add(node)
+        for i in range(self.replica_count):
+            replica_key = "%s:%d" % (node, i)
+            position = self.compute_ring_position(replica_key)
+            while position in self.positions:
+                position += 1
+            self.positions.add(position)
+            bisect.insort(self.ring, (position, node))
+
+    def get_nodes(self, key, count):
+        """
+        returns the first count distinct nodes from the key's ring position
+        """
+        nodes = []
+        position = self.compute_ring_position(key)
+        index = bisect.bisect_left(self.ring, (position, None)) % len(
+            self.ring)
+        last_index = (index - 1) % len(self.ring)
+        while (
+            len(nodes) < count and
+            len(nodes) < len(self.nodes) and
+            index != last_index
+        ):
+            node = self.ring[index][1]
+            if node not in nodes:
+                nodes.append(node)
+            index = (index + 1) % len(self.ring)
+        return nodes
+
+
 class carbon(object):
     def __init__(self, cfg):
         self.log = logging.getLogger("log.backends.carbon")
         self.log.info("Carbon Backend Initialized")
+        self.convert_time = 0  # seconds the last send spent converting
         try:
             cfg['carbon_servers']
         except:
@@ -244,11 +564,21 @@ class carbon(object):
         else:
             self.replacement_character = cfg['replacement_character']
 
+        # fix_string in a single str.translate, when the replacement is a
+        # single character
+        self.fix_table = None
+        if len(self.replacement_character) == 1:
+            fix_chars = ' \t\n\r\f\v~!$:;%^*()+={}[]|\\/<>'
+            self.fix_table = string.maketrans(
+                fix_chars, self.replacement_character * len(fix_chars))
+
+        self.path_cache = get_path_cache(cfg, self.log)
+
         try:
             cfg['carbon_max_metrics']
             self.carbon_max_metrics = cfg['carbon_max_metrics']
         except:
-            self.carbon_max_metrics = 200
+            self.carbon_max_metrics = 0
 
         try:
             self.carbon_max_metrics = int(self.carbon_max_metrics)
@@ -256,6 +586,26 @@ class carbon(object):
             self.log.critical("carbon_max_metrics needs to be a integer")
             sys.exit(1)
 
+        try:
+            self.carbon_pickle_protocol = int(
+                cfg.get('carbon_pickle_protocol', 2))
+            self.carbon_max_payload = int(
+                cfg.get('carbon_max_payload', 262144))
+        except ValueError:
+            self.log.critical("carbon_pickle_protocol and carbon_max_payload "
+                              "need to be integers")
+            sys.exit(1)
+        if self.carbon_pickle_protocol not in (0, 2):
+            self.log.critical("carbon_pickle_protocol needs to be 0 or 2")
+            sys.exit(1)
+        if self.carbon_max_payload > 1048576:
+            # carbon drops the connection on bigger pickles (MAX_LENGTH)
+            self.log.critical("carbon_max_payload can't be over 1048576")
+            sys.exit(1)
+        if self.carbon_pickle_protocol == 0 and self.carbon_max_metrics < 1:
+            # the original format, chunked by count only
+            self.carbon_max_metrics = 200
+
         try:
             cfg['use_service_desc']
             self.use_service_desc = cfg['use_service_desc']
@@ -286,28 +636,131 @@ class carbon(object):
         except:
             self.carbon_plaintext = False
 
+        try:
+            self.carbon_timeout = float(cfg.get('carbon_timeout', 10))
+            self.carbon_dns_ttl = float(cfg.get('carbon_dns_ttl', 300))
+            self.carbon_backoff_max = float(cfg.get('carbon_backoff_max',
+                                                    300))
+        except ValueError:
+            self.log.critical("carbon_timeout, carbon_dns_ttl and "
+                              "carbon_backoff_max need to be numbers")
+            sys.exit(1)
+
+        self.carbon_relay_method = cfg.get('carbon_relay_method', 'all')
+        if self.carbon_relay_method not in ('all', 'consistent-hashing'):
+            self.log.critical("carbon_relay_method needs to be all or "
+                              "consistent-hashing")
+            sys.exit(1)
+
+        try:
+            self.carbon_replication_factor = int(
+                cfg.get('carbon_replication_factor', 1))
+        except ValueError:
+            self.log.critical("carbon_replication_factor needs to be a "
+                              "integer")
+            sys.exit(1)
+
+        self.connections = []
+        self.ring = None
+        self.ring_connections = {}  # ring node: CarbonConnection
+        if self.carbon_relay_method == 'consistent-hashing':
+            self.ring = ConsistentHashRing([])
+        for (server, port, instance) in self.parse_servers():
+            conn = CarbonConnection(server, port, self.carbon_timeout,
+                                    self.carbon_dns_ttl,
+                                    self.carbon_backoff_max)
+            self.connections.append(conn)
+            if self.ring is not None:
+                # carbon-relay keys its ring on (server, instance) too
+                node = (server, instance)
+                if node in self.ring_connections:
+                    self.log.critical("carbon server %s:%s:%s is in "
+                                      "carbon_servers twice, give them "
+                                      "different instances" % (
+                                          server, port, instance))
+                    sys.exit(1)
+                self.ring_connections[node] = conn
+                self.ring.add_node(node)
+
+    def parse_servers(self):
+        """
+        returns the carbon_servers (server[:port[:instance]]) as a list of
+        (server, port, instance)
+        """
+        servers = []
+        for serv in self.carbon_servers.split(","):
+            parts = serv.strip().split(":")
+            server = parts[0]
+            instance = None
+            if len(parts) > 1:
+                port = int(parts[1])
+            elif self.carbon_plaintext:
+                port = 2003
+            else:
+                port = 2004
+            if len(parts) > 2:
+                instance = parts[2]
+            servers.append((server, port, instance))
+        return servers
+
+    def shard(self, metrics):
+        """
+        splits the metrics between the carbon servers by their place on the
+        hash ring, returns a list of (CarbonConnection, metrics)
+        """
+        shards = {}
+        for m in metrics:
+            path = self.build_path(m)
+            for node in self.ring.get_nodes(path,
+                                            self.carbon_replication_factor):
+                conn = self.ring_connections[node]
+                if conn not in shards:
+                    shards[conn] = []
+                shards[conn].append(m)
+        batches = []
+        for conn in self.connections:
+            if conn in shards:
+                batches.append((conn, shards[conn]))
+        return batches
+
     def convert_messages(self, metrics):
         """
         Converts the metric obj list into graphite messages
         """
         metric_list = []
         messages = []
+        numeric = (not self.carbon_plaintext and
+                   self.carbon_pickle_protocol > 0)
         for m in metrics:
             path = self.build_path(m)
             value = m.VALUE
             timestamp = m.TIMET
             if self.carbon_plaintext:
                 metric_item = "%s %s %s\n" % (path, value, timestamp)
+            elif numeric:
+                # carbon float()s both anyway and drops what it can't
+                try:
+                    metric_item = (path, (int(timestamp), float(value)))
+                except ValueError:
+                    self.log.debug("skipping non numeric metric %s %s %s" %
+                                   (path, value, timestamp))
+                    continue
             else:
                 metric_item = (path, (timestamp, value))
             if self.test_mode:
                 print "%s %s %s" % (path, value, timestamp)
             metric_list.append(metric_item)
-        for metric_list_chunk in self.chunks(metric_list,
-                                             self.carbon_max_metrics):
-            if self.carbon_plaintext:
+        if self.carbon_plaintext:
+            for metric_list_chunk in self.payload_chunks(metric_list):
                 messages.append("".join(metric_list_chunk))
-            else:
+        elif numeric:
+            for metric_list_chunk in self.payload_chunks(metric_list):
+                payload = pickle.dumps(metric_list_chunk,
+                                       self.carbon_pickle_protocol)
+                messages.append(struct.pack("!L", len(payload)) + payload)
+        else:
+            for metric_list_chunk in self.chunks(metric_list,
+                                                 self.carbon_max_metrics):
                 payload = pickle.dumps(metric_list_chunk)
                 header = struct.pack("!L", len(payload))
                 message = header + payload
@@ -320,7 +773,48 @@ class carbon(object):
         for i in xrange(0, len(l), n):
             yield l[i:i + n]
 
+    def payload_chunks(self, items):
+        """
+        Yield successive chunks from items of about carbon_max_payload bytes
+        (and at most carbon_max_metrics items, when that is set)
+        """
+        start = 0
+        size = 0
+        for i in xrange(len(items)):
+            item = items[i]
+            if isinstance(item, tuple):
+                # binary pickle of (path, (int, float)): the path plus
+                # opcodes, a 4 byte int and an 8 byte float
+                item_size = len(item[0]) + 28
+            else:
+                item_size = len(item)
+            if i > start and (
+                    size + item_size > self.carbon_max_payload or
+                    i - start == self.carbon_max_metrics):
+                yield items[start:i]
+                start = i
+                size = 0
+            size += item_size
+        if start < len(items):
+            yield items[start:]
+
     def build_path(self, m):
+        """
+        Builds a carbon metric, or finds it in the path cache
+        """
+        if self.use_service_desc:
+            service_desc = m.SERVICEDESC
+        else:
+            service_desc = None
+        key = (m.METRICBASEPATH, m.GRAPHITEPREFIX, m.HOSTNAME, service_desc,
+               m.GRAPHITEPOSTFIX, m.LABEL)
+        path = self.path_cache.get(key)
+        if path is None:
+            path = self.make_path(m)
+            self.path_cache.put(key, path)
+        return path
+
+    def make_path(self, m):
         """
         Builds a carbon metric
         """
@@ -354,50 +848,68 @@ class carbon(object):
         takes a string and replaces whitespace and invalid carbon chars with
         the global replacement_character
         """
+        if self.fix_table is not None and isinstance(my_string, str):
+            return my_string.translate(self.fix_table)
         invalid_chars = '~!$:;%^*()+={}[]|\/<>'
         my_string = re.sub("\s", self.replacement_character, my_string)
         for char in invalid_chars:
             my_string = my_string.replace(char, self.replacement_character)
         return my_string
 
-    def send(self, metrics):
+    def send_to(self, conn, messages):
         """
-        Connect to the Carbon server
-        Send the metrics
+        Send already converted messages to one carbon server, returns True
+        if it got them
         """
-        ret = 0
-        sock = socket.socket()
-        servers = self.carbon_servers.split(",")
-        for serv in servers:
-            if ":" in serv:
-                server, port = serv.split(":")
-                port = int(port)
-            else:
-                server = serv
-                if self.carbon_plaintext:
-                    port = 2003
-                else:
-                    port = 2004
-            self.log.debug("Connecting to carbon at %s:%s" % (server, port))
-            try:
-                sock.connect((socket.gethostbyname(server), port))
-                self.log.debug("connected")
-            except Exception, ex:
-                self.log.warning("Can't connect to carbon: %s:%s %s" % (
-                                 server, port, ex))
+        if not conn.connect():
+            return False
+        try:
+            for message in messages:
+                conn.sendall(message)
+        except socket.error as ex:
+            self.log.critical("Can't send message to carbon %s error:%s" % (
+                              conn, ex))
+            conn.failed()
+            return False
+        return True
 
+    def send(self, metrics):
+        """
+        Send the metrics to every carbon server, or with consistent-hashing
+        each metric to its carbon_replication_factor servers, (re)connecting
+        as needed. The messages are built once and the same buffers are
+        written to every server that gets them. With several servers they
+        are sent to at the same time, so a slow server doesn't hold up the
+        others. Returns 0 if any server didn't get all of its metrics.
+        """
+        start = time.time()
+        if self.ring is None:
             messages = self.convert_messages(metrics)
-            try:
-                for message in messages:
-                    sock.sendall(message)
-            except Exception, ex:
-                self.log.critical("Can't send message to carbon error:%s" % ex)
-                sock.close()
-                return 0
-            # this only gets returned if nothing failed.
-            ret += len(metrics)
-            sock.close()
-        return ret
+            batches = [(conn, messages, len(metrics))
+                       for conn in self.connections]
+        else:
+            batches = [(conn, self.convert_messages(shard), len(shard))
+                       for (conn, shard) in self.shard(metrics)]
+        self.convert_time = time.time() - start
+        if len(batches) == 1:
+            results = [self.send_to(batches[0][0], batches[0][1])]
+        else:
+            results = [False] * len(batches)
+
+            def send_one(i):
+                results[i] = self.send_to(batches[i][0], batches[i][1])
+
+            threads = []
+            for i in xrange(len(batches)):
+                thread = threading.Thread(target=send_one, args=(i,))
+                thread.daemon = True
+                thread.start()
+                threads.append(thread)
+            for thread in threads:
+                thread.join()
+        if False in results:
+            return 0
+        return sum([batch[2] for batch in batches])
 
 
 # ###########################################################
@@ -407,17 +919,36 @@ class statsd(object):
     def __init__(self, cfg):
         self.log = logging.getLogger("log.backends.statsd")
         self.log.info("Statsd backend initialized")
+        self.convert_time = 0  # seconds the last send spent converting
+        self.dropped = 0  # metrics statsd can't take, since startup
         self.statsd_servers = cfg.get('statsd_servers','127.0.0.1:8125')
         self.statsd_protocol = cfg.get('statsd_protocol','udp')
-        servers = self.statsd_servers.split(",")
+        self.path_cache = get_path_cache(cfg, self.log)
+        try:
+            self.statsd_mtu = int(cfg.get('statsd_mtu', 512))
+            self.statsd_buffer_size = int(cfg.get('statsd_buffer_size',
+                                                  65536))
+            self.statsd_timeout = float(cfg.get('statsd_timeout', 10))
+        except ValueError:
+            self.log.critical("statsd_mtu, statsd_buffer_size and "
+                              "statsd_timeout need to be numbers")
+            sys.exit(1)
+        servers = [server.strip() for server in
+                   self.statsd_servers.split(",")]
         self.statsd_clients = []
         self.statsd_connections = []
+        # the clients live as long as we do, so their sockets are reused for
+        # every spool file
         for server in servers:
             host, port = server.split(":")
             if self.statsd_protocol == 'udp':
-                self.statsd_connections.append(StatsClient(host=host.strip(), port=int(port.strip())))
+                self.statsd_connections.append(StatsClient(
+                    host=host.strip(), port=int(port.strip()),
+                    maxudpsize=self.statsd_mtu))
             else:
-                self.statsd_connections.append(TCPStatsClient(host=host.strip(), port=int(port.strip())))
+                self.statsd_connections.append(TCPStatsClient(
+                    host=host.strip(), port=int(port.strip()),
+                    timeout=self.statsd_timeout))
 
     def set_type(self, metric):
         # detect and set the metric type
@@ -432,57 +963,132 @@ class statsd(object):
         else:
             return 'g'  # default to gauge
 
+    def build_path(self, m):
+        key = (m.METRICBASEPATH, m.GRAPHITEPREFIX, m.HOSTNAME,
+               m.GRAPHITEPOSTFIX, m.LABEL)
+        path = self.path_cache.get(key)
+        if path is None:
+            path = '%s.%s.%s.%s.%s' % key
+            path = re.sub(r'\.$', '', path)  # fix paths that end in dot
+            path = re.sub(r'\.\.', '.', path)  # fix paths with empty values
+            self.path_cache.put(key, path)
+        return path
+
     def convert(self, metrics):
         # Converts the metric object list into a list of statsd tuples
         out_list = []
+        dropped = 0
         for m in metrics:
-            path = '%s.%s.%s.%s.%s' % (m.METRICBASEPATH, m.GRAPHITEPREFIX,
-                                       m.HOSTNAME, m.GRAPHITEPOSTFIX,
-                                       m.LABEL)
-            path = re.sub(r'\.$', '', path)  # fix paths that end in dot
-            path = re.sub(r'\.\.', '.', path)  # fix paths with empty values
+            path = self.build_path(m)
+            try:
+                # the client sends ascii only
+                path.encode('ascii')
+                m.VALUE.encode('ascii')
+            except UnicodeError:
+                dropped += 1
+                continue
             mtype = self.set_type(m)  # gauge|counter|timer|set
             #value = "%s|%s" % (m.VALUE, mtype)  # emit literally this to statsd
             #metric_tuple = "%s:%s" % (path, value)
-            out_list.append((path, m.VALUE, mtype))
-
+            value = m.VALUE
+            if mtype == 'ms':
+                # the client formats timings as floats
+                try:
+                    value = float(value)
+                except ValueError:
+                    self.log.debug("skipping non numeric timing %s %s" % (
+                                   path, value))
+                    continue
+            out_list.append((path, value, mtype))
+        if dropped:
+            self.log.warning("skipped %s metrics with non ascii paths or "
+                             "values" % dropped)
+            self.dropped += dropped
         return out_list
 
+    def send_to(self, server, connection, mlist):
+        """
+        Sends the converted metrics to one statsd server, returns how many it
+        got. UDP datagrams are packed up to statsd_mtu bytes by the client,
+        TCP writes are sent every statsd_buffer_size bytes.
+        """
+        stream = isinstance(connection, TCPStatsClient)
+        sent = 0
+        queued = 0
+        size = 0
+        try:
+            pipe = connection.pipeline()
+            for m, v, t in mlist:
+                if t == 'g':
+                    pipe.gauge(m, v)
+                elif t == 's':
+                    pipe.set(m, v)
+                elif t == 'c':
+                    pipe.incr(m, v)
+                elif t == 'ms':
+                    pipe.timing(m, v)
+                queued += 1
+                if stream:
+                    # path, value and type: about 16 bytes past the path
+                    size += len(m) + 16
+                    if size >= self.statsd_buffer_size:
+                        pipe.send()
+                        sent += queued
+                        queued = 0
+                        size = 0
+            pipe.send()
+            sent += queued
+        except (socket.error, UnicodeError, ValueError) as ex:
+            self.log.critical("Can't send to statsd at %s error:%s" % (
+                              server, ex))
+            if hasattr(connection, 'close'):
+                # reconnects on the next send
+                connection.close()
+        return sent
+
     def send(self, metrics):
-        # Fire metrics at the statsd server and hope for the best (loludp)
+        # Fire metrics at the statsd servers and hope for the best (loludp)
+        # Every server is sent to, and counted, on its own. Returns the count
+        # of the server that got the fewest.
+        start = time.time()
         mlist = self.convert(metrics)
-        for connection in self.statsd_connections:
-            try:
-                if hasattr(connection, 'connect'):
-                    connection.connect()
-
-                pipe = connection.pipeline()
-                for m,v,t in mlist:
-                    if t == 'g':
-                        pipe.gauge(m, v)
-                    elif t == 's':
-                        pipe.set(m, v)
-                    elif t == 'c':
-                        pipe.incr(m, v)
-                    elif t == 'ms':
-                        pipe.timing(m, v)
-
-                pipe.send()
-                if hasattr(connection, 'close'):
-                    connection.close()
-            except:
-                return 0
-
-        return len(mlist)
+        self.convert_time = time.time() - start
+        sent = len(mlist)
+        for server, connection in zip(self.statsd_servers.split(","),
+                                      self.statsd_connections):
+            sent = min(sent, self.send_to(server.strip(), connection, mlist))
+        if sent < len(mlist):
+            return sent
+        # timings that weren't numbers, and non ascii metrics, were dropped
+        # on purpose
+        return len(metrics)
 
 
 # ###########################################################
 # #### influxdb backend  ####################################
 
+def get_influxdb_whitelist(cfg, log):
+    """
+    returns a Whitelist of the influxdb_whitelist substrings of the service
+    descriptions to send, or None to send everything
+    """
+    if 'influxdb_whitelist' in cfg:
+        patterns = cfg['influxdb_whitelist']
+    elif 'inluxdb_whitelist' in cfg:
+        log.warning("inluxdb_whitelist is deprecated, please rename it to "
+                    "influxdb_whitelist in graphios.cfg")
+        patterns = cfg['inluxdb_whitelist']
+    else:
+        return None
+    return Whitelist(json.loads(patterns), get_path_cache(cfg, log),
+                     literal=True)
+
+
 class influxdb(object):
     def __init__(self, cfg):
         self.log = logging.getLogger("log.backends.influxdb")
         self.log.info("InfluxDB backend initialized")
+        self.convert_time = 0  # seconds the last send spent converting
         self.default_ports = {'https': 8087, 'http': 8086}
         self.timeout = 5
         self.ssl = False
@@ -516,24 +1122,23 @@ class influxdb(object):
         if 'influxdb_extra_tags' in cfg:
             self.extra_tags = json.loads(cfg['influxdb_extra_tags'])
 
-        if 'inluxdb_whitelist' in cfg:
-            self.whitelist = json.loads(cfg['inluxdb_whitelist'])
+        self.whitelist = get_influxdb_whitelist(cfg, self.log)
+
+        self.group_fields = cfg.get('influxdb_group_fields', False) is True
 
         self.influxdb = InfluxDBClient(self.influxdb_servers[0].split(":")[0], self.influxdb_servers[0].split(":")[1], self.influxdb_user, self.influxdb_password, self.influxdb_db, ssl=self.ssl)
 
     def send(self, metrics):
         """ Connect to influxdb and send metrics """
         series = []
+        points = {}  # (measurement, host, time): point, with group_fields
+        included = 0  # metrics in the series
+        start = time.time()
         for m in metrics:
-            matching = False
-            if self.whitelist is not None:
-                for item in self.whitelist:
-                    if item in m.SERVICEDESC:
-                        matching = True
-            else:
-                matching = True
-
-            if not matching:
+            if (self.whitelist is not None and
+                    not self.whitelist.match(m.SERVICEDESC)):
+                # left out on purpose, counts as sent
+                included += 1
                 continue
 
             dt = datetime.datetime.utcfromtimestamp(int(m.TIMET)).isoformat() + "Z"
@@ -546,6 +1151,13 @@ class influxdb(object):
             except:
                 continue
 
+            if self.group_fields:
+                key = (m.SERVICEDESC, m.HOSTNAME, dt)
+                if key in points:
+                    points[key]["fields"][m.LABEL] = value
+                    included += 1
+                    continue
+
             tmp_series = {"measurement": m.SERVICEDESC,
                             "time": dt,
                             "tags": {
@@ -558,6 +1170,10 @@ class influxdb(object):
                         tmp_series["tags"][k] = v
 
             series.append(tmp_series)
+            included += 1
+            if self.group_fields:
+                points[key] = tmp_series
+        self.convert_time = time.time() - start
 
         try:
             self.influxdb.write_points(series)
@@ -565,7 +1181,219 @@ class influxdb(object):
             print str(e)
             return 0
 
-        return len(series)
+        return included
+
+
+class influxdb09(object):
+    """
+    Writes the InfluxDB line protocol straight to /write. Lines are built
+    from cached, pre-escaped prefixes and posted influxdb_max_metrics at a
+    time over kept alive HTTP connections, optionally gzipped, to the first
+    of the influxdb_servers that takes them or to all of them.
+    """
+    def __init__(self, cfg):
+        self.log = logging.getLogger("log.backends.influxdb09")
+        self.log.info("InfluxDB 0.9 backend initialized")
+        self.convert_time = 0  # seconds the last send spent converting
+        self.default_ports = {'https': 8087, 'http': 8086}
+        self.scheme = 'http'
+        self.extra_tags = {}
+        self.influxdb_db = "nagios"
+        self.influxdb_servers = ['127.0.0.1']
+
+        if 'influxdb_use_ssl' in cfg:
+            if cfg['influxdb_use_ssl']:
+                self.scheme = 'https'
+
+        if 'influxdb_servers' in cfg:
+            self.influxdb_servers = cfg['influxdb_servers'].split(',')
+
+        if 'influxdb_user' in cfg:
+            self.influxdb_user = cfg['influxdb_user']
+        else:
+            self.log.critical("Missing influxdb_user in graphios.cfg")
+            sys.exit(1)
+
+        if 'influxdb_password' in cfg:
+            self.influxdb_password = cfg['influxdb_password']
+        else:
+            self.log.critical("Missing influxdb_password in graphios.cfg")
+            sys.exit(1)
+
+        if 'influxdb_db' in cfg:
+            self.influxdb_db = cfg['influxdb_db']
+
+        if 'influxdb_extra_tags' in cfg:
+            self.extra_tags = json.loads(cfg['influxdb_extra_tags'])
+
+        try:
+            self.influxdb_max_metrics = int(cfg.get('influxdb_max_metrics',
+                                                    250))
+            self.influxdb_timeout = float(cfg.get('influxdb_timeout', 5))
+        except ValueError:
+            self.log.critical("influxdb_max_metrics and influxdb_timeout "
+                              "need to be numbers")
+            sys.exit(1)
+
+        self.influxdb_servers_mode = cfg.get('influxdb_servers_mode',
+                                             'failover')
+        if self.influxdb_servers_mode not in ('failover', 'all'):
+            self.log.critical("influxdb_servers_mode needs to be failover or "
+                              "all")
+            sys.exit(1)
+
+        self.influxdb_gzip = cfg.get('influxdb_gzip', False) is True
+        self.group_fields = cfg.get('influxdb_group_fields', False) is True
+        self.whitelist = get_influxdb_whitelist(cfg, self.log)
+
+        self.path_cache = get_path_cache(cfg, self.log)
+        self.write_url = "/write?%s" % urllib.urlencode(
+            {'db': self.influxdb_db, 'precision': 's'})
+        self.headers = urllib3.util.make_headers(
+            keep_alive=True, basic_auth='%s:%s' % (self.influxdb_user,
+                                                   self.influxdb_password))
+        self.headers['Content-Type'] = 'text/plain; charset=utf-8'
+        if self.influxdb_gzip:
+            self.headers['Content-Encoding'] = 'gzip'
+
+        # one connection per server, kept open between sends
+        self.pools = []
+        for server in self.influxdb_servers:
+            parts = server.strip().split(":")
+            if len(parts) > 1:
+                port = int(parts[1])
+            else:
+                port = self.default_ports[self.scheme]
+            if self.scheme == 'https':
+                pool = urllib3.HTTPSConnectionPool(
+                    parts[0], port, maxsize=1, timeout=self.influxdb_timeout,
+                    cert_reqs='CERT_NONE')
+            else:
+                pool = urllib3.HTTPConnectionPool(
+                    parts[0], port, maxsize=1, timeout=self.influxdb_timeout)
+            self.pools.append(("%s:%s" % (parts[0], port), pool))
+
+    def escape_measurement(self, value):
+        return value.replace(',', '\\,').replace(' ', '\\ ')
+
+    def escape_key(self, value):
+        return value.replace(',', '\\,').replace('=', '\\=').replace(
+            ' ', '\\ ')
+
+    def series_field(self, m):
+        """
+        returns the escaped 'measurement,tags' series and field key of the
+        metric, or None if it has no service description to be measured by
+        """
+        key = (m.SERVICEDESC, m.HOSTNAME, m.LABEL)
+        series_field = self.path_cache.get(key)
+        if series_field is None:
+            if m.SERVICEDESC == '':
+                return None
+            tags = {}
+            for k, v in self.extra_tags.items():
+                tags[k] = v
+            if m.HOSTNAME != '':
+                tags['host'] = m.HOSTNAME
+            # influxdb wants the tags sorted by key
+            tag_list = [",%s=%s" % (self.escape_key(k), self.escape_key(v))
+                        for (k, v) in sorted(tags.items())]
+            series_field = ("%s%s" % (self.escape_measurement(m.SERVICEDESC),
+                                      "".join(tag_list)),
+                            self.escape_key(m.LABEL))
+            self.path_cache.put(key, series_field)
+        return series_field
+
+    def convert(self, metrics):
+        """
+        returns the metrics as a list of line protocol lines, skipping the
+        ones that aren't whitelisted, numbers or have no service description.
+        With influxdb_group_fields the labels of a series at the same time
+        are written as the fields of one point.
+        """
+        lines = []
+        points = {}  # (series, time): fields, with group_fields
+        for m in metrics:
+            if (self.whitelist is not None and
+                    not self.whitelist.match(m.SERVICEDESC)):
+                continue
+            series_field = self.series_field(m)
+            if series_field is None:
+                continue
+            (series, field) = series_field
+            try:
+                field = "%s=%r" % (field, float(m.VALUE))
+                timestamp = int(m.TIMET)
+            except ValueError:
+                self.log.debug("skipping non numeric metric %s %s=%s %s" % (
+                               series, field, m.VALUE, m.TIMET))
+                continue
+            if not self.group_fields:
+                lines.append("%s %s %d\n" % (series, field, timestamp))
+            elif (series, timestamp) in points:
+                points[(series, timestamp)].append(field)
+            else:
+                fields = [field]
+                points[(series, timestamp)] = fields
+                lines.append((series, fields, timestamp))
+        if self.group_fields:
+            lines = ["%s %s %d\n" % (point[0], ",".join(point[1]), point[2])
+                     for point in lines]
+        return lines
+
+    def post(self, server, pool, body):
+        """
+        POSTs one batch to one server, returns True if it took it
+        """
+        try:
+            response = pool.urlopen('POST', self.write_url, body=body,
+                                    headers=self.headers, retries=False)
+        except (urllib3.exceptions.HTTPError, socket.error) as ex:
+            self.log.warning("Can't send to influxdb at %s: %s" % (
+                             server, ex))
+            return False
+        if response.status // 100 != 2:
+            self.log.warning("influxdb at %s refused the metrics: %s %s" % (
+                             server, response.status, response.data[:200]))
+            return False
+        return True
+
+    def write(self, body):
+        """
+        writes one batch to every server, or to the first that takes it.
+        returns True if it was written
+        """
+        if self.influxdb_gzip:
+            # level 1, the lines repeat enough that it does most of the work
+            gzipper = zlib.compressobj(1, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            body = gzipper.compress(body) + gzipper.flush()
+        for i in xrange(len(self.pools)):
+            (server, pool) = self.pools[i]
+            if self.post(server, pool, body):
+                if self.influxdb_servers_mode == 'failover':
+                    if i > 0:
+                        # stick with the server that works
+                        self.log.info("failing over to influxdb at %s" %
+                                      server)
+                        self.pools.insert(0, self.pools.pop(i))
+                    return True
+            elif self.influxdb_servers_mode == 'all':
+                return False
+        return self.influxdb_servers_mode == 'all'
+
+    def send(self, metrics):
+        """
+        Sends the metrics in batches of influxdb_max_metrics points, returns
+        0 if any batch wasn't written (influxdb overwrites the points that
+        are sent again)
+        """
+        start = time.time()
+        lines = self.convert(metrics)
+        self.convert_time = time.time() - start
+        for i in xrange(0, len(lines), self.influxdb_max_metrics):
+            if not self.write("".join(lines[i:i + self.influxdb_max_metrics])):
+                return 0
+        return len(metrics)
 
 
 # ###########################################################
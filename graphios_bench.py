@@ -0,0 +1,471 @@
+#!/usr/bin/python -tt
+# vim: set ts=4 sw=4 tw=79 et :
+#
+# graphios_bench: benchmarks for the graphios hot paths.
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# Generates a synthetic nagios perfdata spool file and runs each stage of
+# graphios against it on its own, and the whole thing end to end against
+# local stand-in carbon, statsd, librato and influxdb servers, eg:
+#
+#   ./graphios_bench.py --lines 100000
+#   ./graphios_bench.py --stages parse_stream,carbon_convert
+#
+# Every stage runs in a fresh child process, and reports metrics/sec and how
+# much the peak memory of the process grew while it ran.
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from optparse import OptionParser
+from SocketServer import ThreadingMixIn
+import graphios
+import graphios_backends as backends
+import logging
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+
+parser = OptionParser("""usage: %prog [options]
+benchmarks the graphios perfdata processing.
+""")
+parser.add_option("--lines", dest="lines", type="int", default=50000,
+                  help="perfdata lines in the generated spool file")
+parser.add_option("--files", dest="files", type="int", default=4,
+                  help="spool files the lines are spread over end to end")
+parser.add_option("--file", dest="file_name", default="",
+                  help="use this spool file instead of generating one")
+parser.add_option("--seed", dest="seed", type="int", default=1,
+                  help="random seed for the generated spool file")
+parser.add_option("--stages", dest="stages", default="",
+                  help="comma separated stages to run (default all)")
+parser.add_option("--list", action="store_true", dest="list",
+                  help="list the stages and exit")
+
+# perfdata strings as real nagios plugins report them
+perfdata_samples = [
+    "rta=4.029ms;10.000;30.000;0; pl=0%;5;10;; rtmax=4.996ms;;;; "
+    "rtmin=3.066ms;;;;",
+    "load1=8.41;20;22;; load5=6.06;18;20;; load15=5.58;16;18",
+    "/=1024MB;1800;1900;0;2048 /var=512MB;1800;1900;0;2048 "
+    "/home=12MB;1800;1900;0;2048 /tmp=1MB;1800;1900;0;2048",
+    "time=0.012s;;;0.000000 size=1234B;;;0",
+    "in_octets=123456789c out_octets=987654321c",
+    "users=3;5;10;0",
+]
+
+bench_cfg = {
+    "replacement_character": "_",
+    "use_service_desc": True,
+    "reverse_hostname": False,
+    "replace_hostname": True,
+    "spool_workers": 0,
+    "test_mode": False,
+    "librato_email": "bench@example.com",
+    "librato_token": "bench",
+    "influxdb_user": "bench",
+    "influxdb_password": "bench",
+}
+
+
+def generate_perfdata(file_name, lines, seed=1):
+    """
+    writes a spool file of host and service perfdata lines in the format of
+    the nagios_perfdata.cfg templates
+    """
+    rand = random.Random(seed)
+    timet = int(time.time())
+    out = open(file_name, "w")
+    for i in xrange(lines):
+        host = "host%04d.example.com" % rand.randint(0, 2000)
+        perfdata = rand.choice(perfdata_samples)
+        if rand.random() < 0.2:
+            fields = ["DATATYPE::HOSTPERFDATA",
+                      "TIMET::%s" % timet,
+                      "HOSTNAME::%s" % host,
+                      "HOSTPERFDATA::%s" % perfdata,
+                      "HOSTCHECKCOMMAND::check-host-alive",
+                      "HOSTSTATE::UP",
+                      "HOSTSTATETYPE::HARD",
+                      "GRAPHITEPREFIX::nagios.ping",
+                      "GRAPHITEPOSTFIX::$_HOSTGRAPHITEPOSTFIX$",
+                      "METRICTYPE::$_HOSTMETRICTYPE$"]
+        else:
+            fields = ["DATATYPE::SERVICEPERFDATA",
+                      "TIMET::%s" % timet,
+                      "HOSTNAME::%s" % host,
+                      "SERVICEDESC::service %d" % rand.randint(0, 30),
+                      "SERVICEPERFDATA::%s" % perfdata,
+                      "SERVICECHECKCOMMAND::check_nrpe!check_something",
+                      "HOSTSTATE::UP",
+                      "HOSTSTATETYPE::HARD",
+                      "SERVICESTATE::OK",
+                      "SERVICESTATETYPE::HARD",
+                      "GRAPHITEPREFIX::nagios.services",
+                      "GRAPHITEPOSTFIX::$_SERVICEGRAPHITEPOSTFIX$",
+                      "METRICTYPE::$_SERVICEMETRICTYPE$"]
+        out.write("\t".join(fields) + "\n")
+        if i % 15 == 14:
+            timet += 1
+    out.close()
+
+
+# ###########################################################
+# #### stand-in servers
+
+class TCPSink(threading.Thread):
+    """
+    accepts connections and throws away whatever is sent (carbon)
+    """
+    def __init__(self):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.sock = socket.socket()
+        self.sock.bind(("127.0.0.1", 0))
+        self.sock.listen(16)
+        self.port = self.sock.getsockname()[1]
+        self.received = 0
+
+    def run(self):
+        while True:
+            conn = self.sock.accept()[0]
+            reader = threading.Thread(target=self.read, args=(conn,))
+            reader.daemon = True
+            reader.start()
+
+    def read(self, conn):
+        while True:
+            data = conn.recv(262144)
+            if not data:
+                conn.close()
+                return
+            self.received += len(data)
+
+
+class UDPSink(threading.Thread):
+    """
+    throws away datagrams (statsd)
+    """
+    def __init__(self):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(("127.0.0.1", 0))
+        self.port = self.sock.getsockname()[1]
+        self.received = 0
+
+    def run(self):
+        while True:
+            self.received += len(self.sock.recv(65536))
+
+
+class HTTPSinkHandler(BaseHTTPRequestHandler):
+    """
+    answers every POST the way librato and influxdb do on success
+    """
+    protocol_version = "HTTP/1.1"
+    # answer in one write, or the kept alive client waits out delayed acks
+    wbufsize = -1
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.getheader("content-length", 0)))
+        if self.path.startswith("/write"):
+            self.send_response(204)
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class HTTPSink(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        HTTPServer.__init__(self, ("127.0.0.1", 0), HTTPSinkHandler)
+        self.port = self.server_address[1]
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+
+def start_sinks(cfg):
+    """
+    starts the stand-in servers and points the backends in cfg at them
+    """
+    carbon = TCPSink()
+    carbon.start()
+    statsd = UDPSink()
+    statsd.start()
+    http = HTTPSink()
+    cfg["carbon_servers"] = "127.0.0.1:%s" % carbon.port
+    cfg["statsd_servers"] = "127.0.0.1:%s" % statsd.port
+    cfg["influxdb_servers"] = "127.0.0.1:%s" % http.port
+    cfg["librato_api"] = "http://127.0.0.1:%s" % http.port
+    return cfg
+
+
+# ###########################################################
+# #### stages
+#
+# each stage is a (setup, run) pair. setup(file_name) runs untimed and
+# returns the argument run() gets, run() returns how many metrics it handled
+
+def parse_metrics(file_name):
+    return graphios.process_log(file_name)
+
+
+def run_legacy_parse(file_name):
+    return len(graphios.legacy_process_log(file_name))
+
+
+def run_stream_parse(file_name):
+    return len(graphios.stream_process_log(file_name))
+
+
+def setup_lines(file_name):
+    lines = []
+    for line in open(file_name):
+        if line.startswith("DATATYPE::"):
+            lines.append(line)
+    return lines
+
+
+def run_get_mobj(lines):
+    for line in lines:
+        graphios.get_mobj(line.split('\t'))
+    return len(lines)
+
+
+def run_parse_line(lines):
+    for line in lines:
+        graphios.parse_line(line)
+    return len(lines)
+
+
+def setup_carbon(file_name):
+    return (backends.carbon(graphios.cfg), parse_metrics(file_name))
+
+
+def run_carbon_build_path(state):
+    (carbon, metrics) = state
+    for m in metrics:
+        carbon.build_path(m)
+    return len(metrics)
+
+
+def setup_carbon_warm(file_name):
+    state = setup_carbon(file_name)
+    run_carbon_build_path(state)
+    return state
+
+
+def run_carbon_fix_string(state):
+    (carbon, metrics) = state
+    for m in metrics:
+        carbon.fix_string(m.SERVICEDESC)
+    return len(metrics)
+
+
+def run_carbon_convert(state):
+    (carbon, metrics) = state
+    carbon.convert_messages(metrics)
+    return len(metrics)
+
+
+def setup_carbon_plaintext(file_name):
+    cfg = dict(graphios.cfg)
+    cfg["carbon_plaintext"] = True
+    return (backends.carbon(cfg), parse_metrics(file_name))
+
+
+def setup_statsd(file_name):
+    return (backends.statsd(graphios.cfg), parse_metrics(file_name))
+
+
+def run_statsd_convert(state):
+    (statsd, metrics) = state
+    statsd.convert(metrics)
+    return len(metrics)
+
+
+def setup_librato(file_name):
+    return (backends.librato(graphios.cfg), parse_metrics(file_name))
+
+
+def run_librato_add_measure(state):
+    (librato, metrics) = state
+    for m in metrics:
+        librato.add_measure(m)
+    return len(metrics)
+
+
+def setup_send(backend):
+    def setup(file_name):
+        cfg = start_sinks(dict(graphios.cfg))
+        backend_obj = getattr(backends, backend)(cfg)
+        return (backend_obj, parse_metrics(file_name))
+    return setup
+
+
+def run_send(state):
+    (backend_obj, metrics) = state
+    backend_obj.send(metrics)
+    return len(metrics)
+
+
+def setup_end_to_end(file_name):
+    """
+    splits the spool file into --files files in a new spool directory, and
+    enables every backend against the stand-in servers
+    """
+    cfg = start_sinks(graphios.cfg)
+    for backend in ("carbon", "statsd", "librato", "influxdb"):
+        cfg["enable_%s" % backend] = True
+    lines = open(file_name).readlines()
+    directory = tempfile.mkdtemp(prefix="graphios_bench_spool.")
+    per_file = len(lines) / options.files + 1
+    for i in xrange(options.files):
+        out = open(os.path.join(directory, "service-perfdata.%d" % i), "w")
+        out.writelines(lines[i * per_file:(i + 1) * per_file])
+        out.close()
+    graphios.spool_directory = directory
+    graphios.init_backends()
+    be = graphios.be
+    # count metrics on the way through
+    counter = CountingBackend()
+    be["enabled_backends"]["count"] = counter
+    be["send_timeouts"]["count"] = None
+    return (directory, counter)
+
+
+class CountingBackend(object):
+    def __init__(self):
+        self.metrics = 0
+
+    def send(self, metrics):
+        self.metrics += len(metrics)
+        return len(metrics)
+
+
+def run_end_to_end(state):
+    (directory, counter) = state
+    try:
+        graphios.process_spool_dir(directory)
+    finally:
+        shutil.rmtree(directory, True)
+    return counter.metrics
+
+
+stages = [
+    ("parse_legacy", lambda f: f, run_legacy_parse),
+    ("parse_stream", lambda f: f, run_stream_parse),
+    ("get_mobj", setup_lines, run_get_mobj),
+    ("parse_line", setup_lines, run_parse_line),
+    ("carbon_build_path", setup_carbon, run_carbon_build_path),
+    ("carbon_build_path_warm", setup_carbon_warm, run_carbon_build_path),
+    ("carbon_fix_string", setup_carbon, run_carbon_fix_string),
+    ("carbon_convert", setup_carbon, run_carbon_convert),
+    ("carbon_convert_plain", setup_carbon_plaintext, run_carbon_convert),
+    ("statsd_convert", setup_statsd, run_statsd_convert),
+    ("librato_add_measure", setup_librato, run_librato_add_measure),
+    ("carbon_send", setup_send("carbon"), run_send),
+    ("statsd_send", setup_send("statsd"), run_send),
+    ("librato_send", setup_send("librato"), run_send),
+    ("influxdb_send", setup_send("influxdb"), run_send),
+    ("influxdb09_send", setup_send("influxdb09"), run_send),
+    ("end_to_end", setup_end_to_end, run_end_to_end),
+]
+
+
+# ###########################################################
+# #### measuring
+
+def max_rss():
+    """
+    peak resident set size of this process in bytes (linux reports KiB)
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _measure_child(setup, run, file_name, queue):
+    try:
+        state = setup(file_name)
+        rss_before = max_rss()
+        start = time.time()
+        items = run(state)
+        elapsed = time.time() - start
+        queue.put((items, elapsed, max_rss() - rss_before))
+    except Exception as ex:
+        queue.put(ex)
+
+
+def measure(setup, run, file_name):
+    """
+    runs a stage in a fresh child process so every stage starts with the
+    same heap. returns (metrics, seconds, peak memory growth in bytes)
+    """
+    queue = multiprocessing.Queue()
+    proc = multiprocessing.Process(target=_measure_child,
+                                   args=(setup, run, file_name, queue))
+    proc.start()
+    result = queue.get()
+    proc.join()
+    if isinstance(result, Exception):
+        raise result
+    return result
+
+
+def report(name, items, elapsed, mem):
+    if elapsed > 0:
+        rate = items / elapsed
+    else:
+        rate = 0
+    print("%-22s %9d %8.3fs %12.0f/s %9.1f MiB %6d B/metric" % (
+          name, items, elapsed, rate, mem / 1048576.0,
+          mem / max(items, 1)))
+
+
+def main():
+    global options
+    (options, args) = parser.parse_args()
+    if options.list:
+        for stage in stages:
+            print(stage[0])
+        return 0
+    selected = [stage for stage in stages if options.stages == "" or
+                stage[0] in options.stages.split(",")]
+    graphios.cfg.update(bench_cfg)
+    logging.getLogger("log").addHandler(logging.StreamHandler())
+    logging.getLogger("log").setLevel(logging.ERROR)
+    file_name = options.file_name
+    if file_name == "":
+        (fd, file_name) = tempfile.mkstemp(prefix="graphios_bench.")
+        os.close(fd)
+        generate_perfdata(file_name, options.lines, options.seed)
+    print("spool file: %s (%d bytes)" % (file_name,
+                                         os.path.getsize(file_name)))
+    print("%-22s %9s %9s %14s %13s %15s" % ("stage", "count", "time",
+                                            "rate", "peak mem", ""))
+    try:
+        for (name, setup, run) in selected:
+            report(name, *measure(setup, run, file_name))
+    finally:
+        if options.file_name == "":
+            os.remove(file_name)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,93 @@
+# vim: set ts=4 sw=4 tw=79 et :
+"""
+Aggregator: the points of a window, with more than one function per rule
+"""
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import graphios
+import graphios_backends
+
+
+def metric(timet, value, service_desc="Temp\xc3\xa9rature"):
+    context = graphios.GraphiosMetric()
+    context.HOSTNAME = "web01"
+    context.SERVICEDESC = service_desc
+    context.TIMET = str(timet)
+    return graphios.PerfMetric(context, "temp", value, "")
+
+
+class AggregatorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.saved_cfg = graphios.cfg
+        self.saved_aggregator = graphios.aggregator
+        self.directory = tempfile.mkdtemp()
+        graphios.cfg = {
+            "replacement_character": "_",
+            "use_service_desc": True,
+            "aggregate_rules": json.dumps([{"pattern": "temp",
+                                            "window": 60,
+                                            "functions": ["avg", "max",
+                                                          "sum", "count"]}]),
+            "aggregate_delay": "0",
+            "aggregate_state_file": os.path.join(self.directory,
+                                                 "_aggregate.state"),
+        }
+        graphios.init_aggregator()
+        self.aggregator = graphios.aggregator
+
+    def tearDown(self):
+        graphios.cfg = self.saved_cfg
+        graphios.aggregator = self.saved_aggregator
+        shutil.rmtree(self.directory)
+
+    def flush(self):
+        return dict((m.LABEL, m) for m in self.aggregator.flush(2e9))
+
+    def test_functions(self):
+        points = [metric(1200000000, "1"), metric(1200000030, "3")]
+        self.assertEqual(self.aggregator.absorb(points), [])
+        out = self.flush()
+        self.assertEqual(sorted(out), ["temp_avg", "temp_count", "temp_max",
+                                       "temp_sum"])
+        self.assertEqual(out["temp_avg"].VALUE, "2.0")
+        self.assertEqual(out["temp_max"].VALUE, "3.0")
+        self.assertEqual(out["temp_sum"].VALUE, "4.0")
+        self.assertEqual(out["temp_count"].VALUE, "2")
+        self.assertEqual(out["temp_avg"].TIMET, "1200000000")
+
+    def test_labels_are_bytes(self):
+        # a unicode label can't be joined with a non ascii service
+        # description
+        self.aggregator.absorb([metric(1200000000, "1")])
+        carbon = graphios_backends.carbon({"use_service_desc": True})
+        for m in self.flush().values():
+            self.assertTrue(type(m.LABEL) is str)
+            carbon.make_path(m)
+
+    def test_repeated(self):
+        points = [metric(1200000000, "1"), metric(1200000030, "2")]
+        self.aggregator.absorb(points)
+        # the spool file was kept, and is processed again
+        self.aggregator.absorb(points)
+        out = self.flush()
+        self.assertEqual(out["temp_sum"].VALUE, "3.0")
+        self.assertEqual(out["temp_count"].VALUE, "2")
+        self.assertEqual(self.aggregator.repeated, 2)
+
+    def test_saved_windows(self):
+        self.aggregator.absorb([metric(1200000000, "1")])
+        self.aggregator.save(graphios.cfg["aggregate_state_file"])
+        graphios.init_aggregator()
+        self.aggregator = graphios.aggregator
+        self.aggregator.absorb([metric(1200000030, "3")])
+        self.assertEqual(self.flush()["temp_sum"].VALUE, "4.0")
+
+
+if __name__ == "__main__":
+    unittest.main()
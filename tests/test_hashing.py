@@ -0,0 +1,81 @@
+# vim: set ts=4 sw=4 tw=79 et :
+"""
+ConsistentHashRing has to place metrics where carbon-relay's
+consistent-hashing RELAY_METHOD does. The expected nodes come from
+carbon.hashing.ConsistentHashRing (carbon 1.1, carbon_ch).
+"""
+
+import unittest
+
+from graphios_backends import ConsistentHashRing
+
+SERVERS = [("10.0.0.1", None), ("10.0.0.2", None), ("10.0.0.3", None)]
+
+INSTANCES = [("10.0.0.1", "a"), ("10.0.0.1", "b"), ("10.0.0.2", "a"),
+             ("10.0.0.2", "b")]
+
+# metric path: the first 3 nodes carbon-relay gives it
+SERVERS_PLACEMENT = {
+    "nagios.web01.load.load1": [("10.0.0.3", None), ("10.0.0.2", None),
+                                ("10.0.0.1", None)],
+    "nagios.web01.load.load5": [("10.0.0.2", None), ("10.0.0.3", None),
+                                ("10.0.0.1", None)],
+    "nagios.db02.ping.rta": [("10.0.0.2", None), ("10.0.0.3", None),
+                             ("10.0.0.1", None)],
+    "nagios.db02.ping.pl": [("10.0.0.3", None), ("10.0.0.2", None),
+                            ("10.0.0.1", None)],
+    "ops.h3.Disk_var.used": [("10.0.0.3", None), ("10.0.0.1", None),
+                             ("10.0.0.2", None)],
+}
+
+INSTANCES_PLACEMENT = {
+    "nagios.web01.load.load1": [("10.0.0.2", "a"), ("10.0.0.1", "a"),
+                                ("10.0.0.1", "b")],
+    "nagios.web01.load.load5": [("10.0.0.2", "a"), ("10.0.0.2", "b"),
+                                ("10.0.0.1", "a")],
+    "nagios.db02.ping.rta": [("10.0.0.2", "a"), ("10.0.0.1", "b"),
+                             ("10.0.0.1", "a")],
+    "nagios.db02.ping.pl": [("10.0.0.1", "b"), ("10.0.0.2", "b"),
+                            ("10.0.0.2", "a")],
+    "ops.h3.Disk_var.used": [("10.0.0.1", "a"), ("10.0.0.1", "b"),
+                             ("10.0.0.2", "b")],
+}
+
+
+class ConsistentHashRingTest(unittest.TestCase):
+
+    def check_placement(self, nodes, placement):
+        ring = ConsistentHashRing(nodes)
+        for (path, expected) in placement.items():
+            for count in (1, 2, 3):
+                self.assertEqual(ring.get_nodes(path, count),
+                                 expected[:count],
+                                 "%s with %s replicas" % (path, count))
+
+    def test_servers(self):
+        self.check_placement(SERVERS, SERVERS_PLACEMENT)
+
+    def test_instances(self):
+        self.check_placement(INSTANCES, INSTANCES_PLACEMENT)
+
+    def test_one_server(self):
+        ring = ConsistentHashRing([("127.0.0.1", None)])
+        self.assertEqual(ring.get_nodes("nagios.web01.load.load1", 2),
+                         [("127.0.0.1", None)])
+
+    def test_taken_position(self):
+        # two of SERVERS' replicas hash to the same position, carbon moves
+        # the second one up
+        ring = ConsistentHashRing(SERVERS)
+        positions = [position for (position, node) in ring.ring]
+        self.assertEqual(len(set(positions)), len(positions))
+        self.assertTrue((7799, ("10.0.0.3", None)) in ring.ring)
+
+    def test_all_nodes(self):
+        ring = ConsistentHashRing(INSTANCES)
+        self.assertEqual(sorted(ring.get_nodes("nagios.db02.ping.rta", 10)),
+                         sorted(INSTANCES))
+
+
+if __name__ == "__main__":
+    unittest.main()
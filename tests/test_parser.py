@@ -0,0 +1,118 @@
+# vim: set ts=4 sw=4 tw=79 et :
+"""
+The stream parser has to produce the same metrics as the legacy one, for
+every combination of the options that change how a spool line is parsed.
+"""
+
+import itertools
+import logging
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+import graphios
+
+PERFDATA = [
+    "rta=4.029ms;10.000;30.000;0; pl=0%;5;10;; rtmax=4.996ms;;;;",
+    "load1=8.41;20;22;; load5=6.06;18;20;; load15=5.58;16;18",
+    "'Disk Usage'=55%;80;90 /=1024MB;;;0;2048 /var=12KB",
+    "time=0.01s size=1234B;;;0 bad a=b=c x=U;;",
+    "in_octets=123456789c out_octets=987c",
+    "",
+    "users=3;5;10;0",
+]
+HOSTS = ["web01.example.com", "db/02", "h3"]
+PREFIXES = ["ops.web", "", "$_SERVICEGRAPHITEPREFIX$", "a b/c"]
+POSTFIXES = ["", "nrdp.load", "$_SERVICEGRAPHITEPOSTFIX$"]
+
+
+def spool_lines(count, seed=1):
+    """
+    returns count spool file lines, host and service check results with
+    custom macros that weren't set, bad labels and stray lines
+    """
+    rand = random.Random(seed)
+    lines = []
+    for i in range(count):
+        r = rand.random()
+        if r < 0.02:
+            lines.append("garbage line\n")
+            continue
+        timet = 1399738074 + i // 50
+        if r < 0.3:
+            fields = ["DATATYPE::HOSTPERFDATA",
+                      "TIMET::%d" % timet,
+                      "HOSTNAME::%s" % rand.choice(HOSTS),
+                      "HOSTPERFDATA::%s" % rand.choice(PERFDATA),
+                      "HOSTCHECKCOMMAND::check-host-alive",
+                      "HOSTSTATE::UP",
+                      "HOSTSTATETYPE::HARD",
+                      "GRAPHITEPREFIX::%s" % rand.choice(PREFIXES),
+                      "GRAPHITEPOSTFIX::%s" % rand.choice(POSTFIXES),
+                      "METRICTYPE::$_HOSTMETRICTYPE$"]
+        else:
+            fields = ["DATATYPE::SERVICEPERFDATA",
+                      "TIMET::%d" % timet,
+                      "HOSTNAME::%s" % rand.choice(HOSTS),
+                      "SERVICEDESC::%s" % rand.choice(["Load", "Disk /var",
+                                                       "PING"]),
+                      "SERVICEPERFDATA::%s" % rand.choice(PERFDATA),
+                      "SERVICECHECKCOMMAND::check_x!1!2",
+                      "HOSTSTATE::UP",
+                      "HOSTSTATETYPE::HARD",
+                      "SERVICESTATE::OK",
+                      "SERVICESTATETYPE::HARD",
+                      "GRAPHITEPREFIX::%s" % rand.choice(PREFIXES),
+                      "GRAPHITEPOSTFIX::%s" % rand.choice(POSTFIXES),
+                      "METRICTYPE::%s" % rand.choice(["counter",
+                                                      "$_SERVICEMETRICTYPE$"])]
+        if r > 0.98:
+            fields.append("")
+        lines.append("\t".join(fields) + "\n")
+    return lines
+
+
+class ParserParityTest(unittest.TestCase):
+
+    def setUp(self):
+        self.saved_cfg = graphios.cfg
+        self.saved_level = graphios.log.level
+        # the bad labels are logged as critical
+        graphios.log.setLevel(logging.CRITICAL + 1)
+        self.directory = tempfile.mkdtemp()
+        self.spool_file = os.path.join(self.directory,
+                                       "service-perfdata.1399738074")
+        spool = open(self.spool_file, "w")
+        spool.writelines(spool_lines(2000))
+        spool.close()
+
+    def tearDown(self):
+        graphios.cfg = self.saved_cfg
+        graphios.log.setLevel(self.saved_level)
+        shutil.rmtree(self.directory)
+
+    def metrics(self, process_log):
+        attributes = sorted(vars(graphios.GraphiosMetric()))
+        return [tuple([getattr(m, a) for a in attributes])
+                for m in process_log(self.spool_file)]
+
+    def test_same_metrics(self):
+        for (service_desc, reverse, replace) in itertools.product(
+                (True, False), repeat=3):
+            graphios.cfg = {"replacement_character": "_",
+                            "use_service_desc": service_desc,
+                            "reverse_hostname": reverse,
+                            "replace_hostname": replace}
+            legacy = self.metrics(graphios.legacy_process_log)
+            stream = self.metrics(graphios.stream_process_log)
+            self.assertTrue(legacy)
+            self.assertEqual(legacy, stream,
+                             "use_service_desc=%s reverse_hostname=%s "
+                             "replace_hostname=%s" % (service_desc, reverse,
+                                                      replace))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,135 @@
+# vim: set ts=4 sw=4 tw=79 et :
+"""
+RateDeriver: wraps, resets, resent and out of order points, and the state
+file
+"""
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import graphios
+
+KEY = "\x00" * 8
+NOW = int(time.time())
+
+
+def counter(timet, value, label="in_octets"):
+    context = graphios.GraphiosMetric()
+    context.HOSTNAME = "web01"
+    context.SERVICEDESC = "eth0"
+    context.TIMET = str(timet)
+    return graphios.PerfMetric(context, label, value, "c")
+
+
+class RateDeriverTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.state_file = os.path.join(self.directory, "_rates.state")
+        self.rates = graphios.RateDeriver(self.state_file, True)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_first_value(self):
+        self.assertEqual(self.rates.add(KEY, NOW, 1000), None)
+
+    def test_rate(self):
+        self.rates.add(KEY, NOW, 1000)
+        self.assertEqual(self.rates.add(KEY, NOW + 10, 1500), 50.0)
+
+    def test_32_bit_wrap(self):
+        self.rates.add(KEY, NOW, 2 ** 32 - 100)
+        self.assertEqual(self.rates.add(KEY, NOW + 10, 100), 20.0)
+
+    def test_64_bit_wrap(self):
+        self.rates.add(KEY, NOW, 2 ** 64 - 4096)
+        self.assertEqual(self.rates.add(KEY, NOW + 16, 4096), 512.0)
+
+    def test_reset(self):
+        self.rates.add(KEY, NOW, 5000000)
+        # too far back for a 32 bit wrap
+        self.assertEqual(self.rates.add(KEY, NOW + 10, 100), None)
+        self.assertEqual(self.rates.add(KEY, NOW + 20, 300), 20.0)
+
+    def test_resent(self):
+        self.rates.add(KEY, NOW, 1000)
+        self.assertEqual(self.rates.add(KEY, NOW + 10, 1500), 50.0)
+        # the same spool file again
+        self.assertEqual(self.rates.add(KEY, NOW + 10, 1500), 50.0)
+        # a different value at the same time isn't the same point
+        self.assertEqual(self.rates.add(KEY, NOW + 10, 1600), None)
+        self.assertEqual(self.rates.add(KEY, NOW + 20, 2000), 50.0)
+
+    def test_resent_reset(self):
+        self.rates.add(KEY, NOW, 5000000)
+        self.rates.add(KEY, NOW + 10, 100)
+        self.assertEqual(self.rates.add(KEY, NOW + 10, 100), None)
+
+    def test_out_of_order(self):
+        self.rates.add(KEY, NOW, 1000)
+        self.rates.add(KEY, NOW + 20, 3000)
+        self.assertEqual(self.rates.add(KEY, NOW + 10, 2000), None)
+        # and the older point didn't change the state
+        self.assertEqual(self.rates.add(KEY, NOW + 30, 4000), 100.0)
+
+    def test_derive(self):
+        self.rates.derive([counter(NOW, "1000")])
+        out = self.rates.derive([counter(NOW + 10, "2000"),
+                                 counter(NOW + 10, "7", "other")])
+        self.assertEqual([(m.LABEL, m.VALUE, m.UOM) for m in out],
+                         [("in_octets", "2000", "c"),
+                          ("in_octets_rate", "100.0", ""),
+                          ("other", "7", "c")])
+        self.rates.keep_counters = False
+        out = self.rates.derive([counter(NOW + 20, "3000")])
+        self.assertEqual([(m.LABEL, m.VALUE) for m in out],
+                         [("in_octets_rate", "100.0")])
+
+    def test_save_load(self):
+        self.rates.add(KEY, NOW, 1000)
+        self.rates.add(KEY, NOW + 10, 1500)
+        self.rates.add("\x01" * 8, NOW, 2 ** 33)
+        self.rates.save()
+        loaded = graphios.RateDeriver(self.state_file, True)
+        loaded.load()
+        self.assertEqual(len(loaded.slots), 2)
+        # resent after a restart still gets its rate
+        self.assertEqual(loaded.add(KEY, NOW + 10, 1500), 50.0)
+        self.assertEqual(loaded.add(KEY, NOW + 20, 2500), 100.0)
+        self.assertEqual(loaded.add("\x01" * 8, NOW + 1, 2 ** 33 + 7), 7.0)
+
+    def test_save_drops_old(self):
+        self.rates.add(KEY, NOW - graphios.RateDeriver.max_age - 10, 1000)
+        self.rates.add("\x01" * 8, NOW, 1000)
+        self.rates.save()
+        self.assertEqual(self.rates.slots.keys(), ["\x01" * 8])
+        loaded = graphios.RateDeriver(self.state_file, True)
+        loaded.load()
+        self.assertEqual(loaded.slots.keys(), ["\x01" * 8])
+
+    def test_no_state_file(self):
+        self.rates.load()
+        self.assertEqual(len(self.rates.slots), 0)
+
+    def test_truncated(self):
+        self.rates.add(KEY, NOW, 1000)
+        self.rates.add("\x01" * 8, NOW, 1000)
+        self.rates.save()
+        state = open(self.state_file, "rb")
+        data = state.read()
+        state.close()
+        for size in (5, len(graphios.RateDeriver.magic) + 8 + 12,
+                     len(data) - 3):
+            state = open(self.state_file, "wb")
+            state.write(data[:size])
+            state.close()
+            loaded = graphios.RateDeriver(self.state_file, True)
+            self.assertRaises(IOError, loaded.load)
+
+
+if __name__ == "__main__":
+    unittest.main()